@@ -1,2 +1,3 @@
+from lot.lexer import *  # noqa
 from lot.lot import *  # noqa
 from lot.parser import *  # noqa
@@ -0,0 +1,449 @@
+import argparse
+import json
+import multiprocessing
+import pickle
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from foc import *
+from ouch import *
+
+from .lot import *
+
+
+def synth(lines=8, kwds=6, ranges=1, actors=20, prefs=3, days=31, seed=0):
+    """
+    Generate LOT source code: 'lines' grid lines of days, a label and
+    'kwds' keywords, days given by 'ranges' range expressions, and
+    'actors' actors with 'prefs' random O/X/! preferences each.
+
+    >>> (grid, policy), _ = parse_lot(synth(lines=2, kwds=3, actors=4))
+    >>> len(grid), len(policy)
+    (2, 4)
+    """
+    rng = random.Random(seed)
+
+    def span():
+        i = rng.randint(1, min(7, days))
+        return f"{i}-{days};{rng.randint(1, 7)}" if days > i else f"{i}"
+
+    spans = [[span() for _ in range(ranges)] for _ in range(lines)]
+
+    def key():
+        i = rng.randrange(lines)
+        return rng.choice(
+            [
+                f"L{i}",
+                f"k{rng.randrange(kwds)}",
+                f"({rng.choice(spans[i])}):L{i}",
+                f"(L{i}, k{rng.randrange(kwds)})",
+                rng.choice(spans[i]),
+            ]
+        )
+
+    def pref():
+        sym = rng.choice("OX!")
+        ks = [key() for _ in range(rng.randint(1, 3))]
+        if sym == "O" and rng.random() < 0.3:
+            ks.append(f"L{rng.randrange(lines)} <= {rng.randint(1, 9)}")
+        return f"- {sym} [{', '.join(ks)}]"
+
+    o = ["# synthetic LOT"]
+    o.append(
+        " +\n".join(
+            f"[{', '.join(spans[i])}][L{i}][{','.join(f'k{j}' for j in range(kwds))}]"
+            for i in range(lines)
+        )
+    )
+    o.append("-----")
+    for i in range(actors):
+        o.append(f"<actor {i}>")
+        o.extend(pref() for _ in range(prefs))
+    return unlines(o) + "\n"
+
+
+def synth_roster(days=31, roles=6, actors=16, seed=0):
+    """
+    Generate LOT source code of a roster like 'examples/demo.lot': roles
+    on each weekday of 'days' days, every role on Sundays, and 'actors'
+    actors mixing @acts, /rest, O, X, ! and relational preferences.
+
+    >>> (grid, policy), _ = parse_lot(synth_roster(days=14, roles=3, actors=5))
+    >>> len(grid), len(policy)
+    (7, 5)
+    """
+    rng = random.Random(seed)
+    week = ["Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat"]
+    names = [f"R{j}" for j in range(roles)]
+    lines = []
+    for d, day in enumerate(week):
+        rs = names if d == 0 else sorted(rng.sample(names, max(1, roles * 2 // 3)))
+        lines.append(f"[{d + 1}-{days};7][{day}][{','.join(rs)}]")
+    nodes = sum(
+        len(range(d + 1, days + 1, 7)) * len(x.split(",")) for d, x in enumerate(lines)
+    )
+    share = max(1, nodes // actors)
+
+    def days_span():
+        i = rng.randint(1, days)
+        return f"{i}-{min(days, i + rng.randint(0, 6))}"
+
+    o = ["# synthetic roster", " +\n".join(lines), "-----"]
+    for i in range(actors):
+        head = f"<actor {i}>"
+        x = rng.random()
+        if x < 0.1:
+            head += f" @{max(1, share // 2)}"
+        elif x < 0.3:
+            head += f" /{rng.randint(1, 3)}"
+        o.append(head)
+        if rng.random() < 0.6:
+            ks = [
+                days_span(),
+                rng.choice(week),
+                f"{rng.choice(week)}:{rng.choice(names)}",
+            ]
+            o.append(f"- X [{', '.join(rng.sample(ks, rng.randint(1, 2)))}]")
+        if rng.random() < 0.3:
+            ks = [rng.choice(week), f"({days_span()}):{rng.choice(names)}"]
+            if rng.random() < 0.5:
+                ks.append(f"{rng.choice(week)} <= {rng.randint(1, 3)}")
+            o.append(f"- O [{', '.join(ks)}]")
+        if rng.random() < 0.3:
+            o.append(f"- ! [{', '.join(rng.sample(names, min(roles, 3)))}]")
+    return unlines(o) + "\n"
+
+
+def solve_args(f, **kwargs):
+    """Options of 'lot' to run 'solve' on file 'f', as if given no flags"""
+    o = dict.fromkeys(
+        (
+            "cal actor node year month output dump hint export max_it min_rest"
+            " min_cap anytime search workers time_limit deadline presolve"
+            " linearization log seed conf block jobs profile pstats"
+        ).split()
+    )
+    o.update(FILE=f, engine="python", no_cache=True)
+    o.update(kwargs)
+    return argparse.Namespace(**o)
+
+
+BUILD = (
+    "gen_vars",
+    "process_policy",
+    "process_policy_np",
+    "rule_single_actor_per_node",
+    "rule_at_most_one_act_per_root",
+    "rule_clip_acts_per_actor",
+    "rule_rest_between_acts",
+    "penalize_low_entropy",
+    "penalize_high_sigma",
+    "set_objective",
+)
+PARSE = ("read", "parse_lot", "gen_nodes", "validate_policy")
+
+
+def run_roster(size, seed=0, time_limit=10, workers=1, engine="python"):
+    """
+    Run the full 'solve' on a synthetic roster of 'size', a tuple of days,
+    roles and actors, with a profile, then summarize its phases and result.
+    """
+    days, roles, actors = size
+    with tempfile.TemporaryDirectory() as tmp:
+        f, prof, dump = (
+            f"{tmp}/{x}" for x in ("roster.lot", "profile.json", "dump.json")
+        )
+        with writer(f, "w", encoding="utf-8") as fh:
+            fh.write(synth_roster(days, roles, actors, seed))
+        args = solve_args(
+            f,
+            seed=seed,
+            time_limit=time_limit,
+            workers=workers,
+            engine=engine,
+            profile=prof,
+            dump=dump,
+        )
+        try:
+            solve(args)
+            error = None
+        except Exception as e:
+            error = str(e)
+        with reader(prof, "r", encoding="utf-8") as fh:
+            p = json.load(fh)
+        nodes = None
+        if error is None:
+            with reader(dump, "r", encoding="utf-8") as fh:
+                nodes = json.load(fh)["nodes"]
+
+    def sec(names):
+        return sum(p["phases"].get(k, {}).get("wall", 0) for k in names)
+
+    last = p["solves"][-1] if p["solves"] else {}
+    return dict(
+        size="x".join(map(str, size)),
+        nodes=len(nodes) if nodes else None,
+        variables=(p["model"] or {}).get("variables"),
+        constraints=sum((p["model"] or {}).get("constraints", {}).values()),
+        parse_sec=sec(PARSE),
+        build_sec=sec(BUILD),
+        solve_sec=sec(["solve"]),
+        iterations=len(p["solves"]),
+        status=error or last.get("status"),
+        objective=last.get("objective"),
+        gap=last.get("gap"),
+        preferred=sum(x != "*" for x in nodes.values()) / len(nodes) if nodes else None,
+        peak_rss=p["peak_rss"],
+    )
+
+
+def bench_solve(sizes, seed=0, time_limit=10, workers=1, engine="python"):
+    """Run each size of roster in a fresh process so its peak memory is its own"""
+    ctx = multiprocessing.get_context("spawn")
+    o = []
+    for size in sizes:
+        with ctx.Pool(1) as pool:
+            o.append(pool.apply(run_roster, (size, seed, time_limit, workers, engine)))
+    return o
+
+
+def regressions(results, baseline, tolerance=0.25, slack=0.05):
+    """
+    Compare results with those of a baseline by size: times beyond the
+    relative 'tolerance' plus 'slack' seconds, a lost status or a lower
+    objective are regressions.
+
+    >>> base = [dict(size="7x2x4", build_sec=1.0, solve_sec=1.0,
+    ...              status="OPTIMAL", objective=-10.0)]
+    >>> new = [dict(base[0], build_sec=2.0, objective=-12.0)]
+    >>> regressions(new, base)
+    ['7x2x4: build_sec 1.000 -> 2.000', '7x2x4: objective -10.0 -> -12.0']
+    """
+    base = {r["size"]: r for r in baseline}
+    o = []
+    for r in results:
+        b = base.get(r["size"])
+        if b is None:
+            continue
+        for k in ("build_sec", "solve_sec"):
+            if r[k] > b[k] * (1 + tolerance) + slack:
+                o.append(f"{r['size']}: {k} {b[k]:.3f} -> {r[k]:.3f}")
+        if b["status"] != r["status"]:
+            o.append(f"{r['size']}: status {b['status']} -> {r['status']}")
+        elif b["objective"] is not None and r["objective"] is not None:
+            if r["objective"] < b["objective"] - abs(b["objective"]) * 1e-6:
+                o.append(f"{r['size']}: objective {b['objective']} -> {r['objective']}")
+    return o
+
+
+def measure(f, *args, repeat=5):
+    """
+    Best wall time of 'repeat' calls, then the peak memory of one call and
+    the number of memory blocks allocated by it that its result still holds.
+    """
+    t = float("inf")
+    for _ in range(repeat):
+        tick = time.perf_counter()
+        f(*args)
+        t = min(t, time.perf_counter() - tick)
+    tracemalloc.start()
+    o = f(*args)
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del o
+    return dict(
+        sec=t,
+        peak_bytes=peak,
+        allocs=sum(x.count for x in snapshot.statistics("filename")),
+    )
+
+
+def bench_parser(repeat=5, **kwargs):
+    """Time the stages of parsing a synthetic LOT program separately"""
+    s = synth(**kwargs)
+    (grid, policy), _ = parse_lot(s)
+    lists = re.findall(r"\[[^\[\]]*\]", s.split("-----")[0])
+    xkwds = [
+        x.strip()
+        for body in re.findall(r"- [OX!] \[(.*)\]", s)
+        for x in re.split(r",\s*(?![^()]*\))", body)
+        if not re.search(r"[<=>]", x)
+    ]
+
+    def run_all(p, xs):
+        return [p(x) for x in xs]
+
+    def normalize_all(rs):
+        return [normalize([r]) for r in rs]
+
+    parsed = [fst(xkwd(x)) for x in xkwds]
+    cases = dict(
+        parse_lot=(parse_lot, [s], len(s)),
+        parse_lot_ref=(lambda x: parse_lot(x, lexer=False), [s], len(s)),
+        kwd_list=(run_all, [kwd_list, lists], sum(map(len, lists))),
+        xkwd=(run_all, [xkwd, xkwds], sum(map(len, xkwds))),
+        normalize=(normalize_all, [parsed], None),
+        validate_policy=(validate_policy, [grid, policy], None),
+    )
+    o = {}
+    for name, (f, args, chars) in cases.items():
+        r = measure(f, *args, repeat=repeat)
+        if chars:
+            r["chars"] = chars
+            r["chars_per_sec"] = chars / r["sec"] if r["sec"] else None
+        o[name] = r
+    return o
+
+
+def replay(f, cap=None, repeat=1, time_limit=None, workers=None, seed=0):
+    """
+    Solve a model saved by 'lot --export FILE' again 'repeat' times, with
+    the cap of acts per actor at 'cap' or at its first value in 'lot', and
+    return the status, wall time and objective of each solve.
+    """
+    with reader(f, "rb") as fh:
+        model, vars, coeffs, x, penalty = load_model(pickle.load(fh))
+    max_acts = cap or len(vars.nodes) // len(vars.actors) or 1
+    x.with_domain(cp_model.Domain(max_acts, max_acts))
+    params = dict(time_limit=time_limit, workers=workers)
+    random.seed(seed)
+    o = []
+    for _ in range(repeat):
+        set_objective(model, vars, coeffs, {}, penalty)
+        solver = gen_solver(params)
+        tick = time.perf_counter()
+        status = solver.solve(model)
+        found = status in (cp_model.FEASIBLE, cp_model.OPTIMAL)
+        o.append(
+            dict(
+                sec=time.perf_counter() - tick,
+                status=solver.status_name(status),
+                objective=solver.objective_value if found else None,
+                bound=solver.best_objective_bound if found else None,
+            )
+        )
+    return o
+
+
+def meta(params):
+    commit = shell("git rev-parse --short HEAD 2>/dev/null")
+    return dict(
+        commit=fst(commit) if commit else None,
+        python=platform.python_version(),
+        time=datetime.now().isoformat(timespec="seconds"),
+        params=params,
+    )
+
+
+def report(results):
+    w = max(map(len, results)) + 2
+    for name, r in results.items():
+        cps = r.get("chars_per_sec")
+        print(
+            f"{name:<{w}}"
+            f"{r['sec'] * 1000:>10.2f} ms"
+            f"{r['peak_bytes'] / 1024:>10.1f} KiB"
+            f"{r['allocs']:>10d} blocks"
+            + (f"{cps / 1000:>10.1f} kchar/s" if cps else "")
+        )
+
+
+def report_replay(runs):
+    for i, r in enumerate(runs):
+        print(
+            f"run {i:<4d}{r['status']:>12s}{r['sec']:>10.2f} s"
+            + (
+                f"{r['objective']:>16.0f}{r['bound']:>16.0f}"
+                if r["objective"] is not None
+                else ""
+            )
+        )
+
+
+def report_solve(results):
+    print(
+        f"{'size':<12}{'vars':>9}{'parse':>9}{'build':>9}{'solve':>9}"
+        f"{'it':>4}  {'status':<10}{'gap':>8}{'pref':>7}{'rss':>9}"
+    )
+    for r in results:
+        gap = f"{r['gap']:.2%}" if r["gap"] is not None else "-"
+        pref = f"{r['preferred']:.1%}" if r["preferred"] is not None else "-"
+        print(
+            f"{r['size']:<12}{r['variables'] or 0:>9d}"
+            f"{r['parse_sec']:>8.2f}s{r['build_sec']:>8.2f}s{r['solve_sec']:>8.2f}s"
+            f"{r['iterations']:>4d}  {r['status'][:10]:<10}{gap:>8}{pref:>7}"
+            f"{r['peak_rss'] / 2**20:>6.0f}MiB"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m lot.bench")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("parser", help="Benchmark the LOT parser")
+    p.add_argument("--lines", type=int, default=8, help="Grid lines")
+    p.add_argument("--kwds", type=int, default=6, help="Keywords per grid line")
+    p.add_argument("--ranges", type=int, default=1, help="Range exprs per line")
+    p.add_argument("--actors", type=int, default=20, help="Actors")
+    p.add_argument("--prefs", type=int, default=3, help="Preferences per actor")
+    p.add_argument("--days", type=int, default=31, help="Upper bound of days")
+    p.add_argument("--seed", type=int, default=0, help="Random seed")
+    p.add_argument("--repeat", type=int, default=5, help="Repeats per stage")
+    p.add_argument("-o", "--output", metavar="FILE", help="Save results as JSON")
+    p = sub.add_parser("replay", help="Solve a model exported by lot again")
+    p.add_argument("f", metavar="FILE", help="Model saved by 'lot --export'")
+    p.add_argument("--cap", type=int, help="Acts per actor at most")
+    p.add_argument("--repeat", type=int, default=1, help="Solves")
+    p.add_argument("--time-limit", type=float, help="Time limit per solve")
+    p.add_argument("--workers", type=int, help="Search workers")
+    p.add_argument("--seed", type=int, default=0, help="Random seed")
+    p.add_argument("-o", "--output", metavar="FILE", help="Save results as JSON")
+    p = sub.add_parser("solve", help="Benchmark solving rosters as they grow")
+    p.add_argument(
+        "--sizes",
+        default="14x3x6,31x4x10,31x6x16,31x9x24",
+        help="Rosters as DAYSxROLESxACTORS, separated by commas",
+    )
+    p.add_argument("--seed", type=int, default=0, help="Random seed")
+    p.add_argument("--time-limit", type=float, default=10, help="Time limit per solve")
+    p.add_argument("--workers", type=int, default=1, help="Search workers")
+    p.add_argument("--engine", choices=("python", "numpy"), default="python")
+    p.add_argument("--baseline", metavar="FILE", help="Compare with results in FILE")
+    p.add_argument("--tolerance", type=float, default=0.25, help="Slower by at most")
+    p.add_argument("-o", "--output", metavar="FILE", help="Save results as JSON")
+    args = parser.parse_args()
+
+    skip = ("cmd", "output", "baseline", "tolerance")
+    params = {k: v for k, v in vars(args).items() if k not in skip}
+    if args.cmd == "replay":
+        results = replay(**params)
+        report_replay(results)
+    elif args.cmd == "solve":
+        sizes = [tuple(map(int, x.split("x"))) for x in args.sizes.split(",")]
+        results = bench_solve(
+            sizes, args.seed, args.time_limit, args.workers, args.engine
+        )
+        report_solve(results)
+    else:
+        results = bench_parser(**params)
+        report(results)
+    if args.output:
+        with writer(args.output) as f:
+            json.dump(dict(meta=meta(params), results=results), f, indent=2)
+    if getattr(args, "baseline", None):
+        with reader(args.baseline) as f:
+            found = regressions(results, json.load(f)["results"], args.tolerance)
+        for x in found:
+            print(f"regression {x}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
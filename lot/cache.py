@@ -0,0 +1,102 @@
+import hashlib
+import os
+import pickle
+
+from ouch import *
+
+CACHE_DIR = "~/.cache/lot"
+CACHE_SIZE = 64 * 1024 * 1024  # bytes per store
+CACHE_VERSION = 5  # bump when the layout of cached objects changes
+
+
+def digest(*xs):
+    """
+    >>> digest("[a][b]") == digest("[a][b]") != digest("[a]", "[b]")
+    True
+    """
+    h = hashlib.sha256(str(CACHE_VERSION).encode())
+    for x in xs:
+        h.update(b"\0")
+        h.update(x if isinstance(x, bytes) else str(x).encode())
+    return h.hexdigest()
+
+
+class store:
+    """On-disk cache of pickled objects under content-addressed keys.
+
+    Entries are touched when read, and 'evict' removes the least recently
+    used ones until the store fits in 'size' bytes. A store that cannot be
+    read or written keeps nothing, so runs go on uncached.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as root:
+    ...     db = store("doctest", root=root)
+    ...     db.put(digest("sofia"), ["maria", "claire"])
+    ...     db.get(digest("sofia")), db.get(digest("francis"))
+    (['maria', 'claire'], None)
+    >>> db = store("doctest", root=__file__)  # not a directory
+    >>> db.put(digest("sofia"), ["maria", "claire"])
+    >>> db.get(digest("sofia")) is None
+    True
+    """
+
+    __slots__ = ("path", "size")
+
+    def __init__(self, name, size=CACHE_SIZE, root=None):
+        try:
+            self.path = mkdir(f"{root or CACHE_DIR}/{name}")
+        except OSError:
+            self.path = None
+        self.size = size
+
+    def get(self, key):
+        if self.path is None:
+            return None
+        f = f"{self.path}/{key}"
+        try:
+            with open(f, "rb") as fh:
+                o = pickle.load(fh)
+            os.utime(f)
+            return o
+        except OSError:  # missing or unreadable entry
+            return None
+        except Exception:  # truncated or stale entry
+            self.remove(key)
+            return None
+
+    def put(self, key, o):
+        if self.path is None:
+            return
+        f = f"{self.path}/{key}"
+        tmp = f"{f}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "wb") as fh:
+                pickle.dump(o, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, f)
+        except OSError:
+            self.remove(os.path.basename(tmp))
+
+    def remove(self, key):
+        try:
+            os.remove(f"{self.path}/{key}")
+        except OSError:
+            pass
+
+    def evict(self):
+        if self.path is None:
+            return
+        entries = []
+        try:
+            with os.scandir(self.path) as it:
+                for e in it:
+                    if e.is_file() and not e.name.endswith(".tmp"):
+                        st = e.stat()
+                        entries.append((st.st_mtime, st.st_size, e.name))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.size:
+                break
+            self.remove(key)
+            total -= size
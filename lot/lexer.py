@@ -0,0 +1,114 @@
+import re
+
+from foc import *
+
+from .parser import *
+
+JUMP = re.compile(r"(?:[ \t\n]+|#[^\n]*)*")
+
+NAME = re.compile(r"[^#<>\n]+")
+
+# tokens outside of square brackets: the grid and policy skeleton
+OUTER = re.compile(
+    r"(?P<bar>-{3,})"
+    r"|(?P<actor><)"
+    r"|(?P<digits>[0-9]+)"
+    r"|(?P<sym>[\[+\-@/!OoXx])"
+)
+
+# tokens inside of square brackets: keyword expressions
+INNER = re.compile(r"(?P<kwd>[^\[\](),<=>:# \t\n]+)|(?P<sym><=|>=|[\[\](),:=<>])")
+
+
+def tokenize(s):
+    """
+    >>> [(k, v) for k, v, *_ in tokenize("[1-3;2,a] + [b] ---")]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('sym', '['), ('kwd', '1-3;2'), ('sym', ','), ('kwd', 'a'), ('sym', ']'),
+     ('sym', '+'), ('sym', '['), ('kwd', 'b'), ('sym', ']'), ('bar', '---'),
+     ('eof', None)]
+
+    >>> [(k, v) for k, v, *_ in tokenize("<sofia> @2 # comment\\n- O [a>=1]")]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('actor', 'sofia'), ('sym', '@'), ('digits', '2'), ('sym', '-'),
+     ('sym', 'O'), ('sym', '['), ('kwd', 'a'), ('sym', '>='), ('kwd', '1'),
+     ('sym', ']'), ('eof', None)]
+    """
+    s = state(s) if isinstance(s, str) else s
+    src, i, depth, o = s.src, s.pos, 0, []
+    while True:
+        i = JUMP.match(src, i).end()
+        s = s.seek(i)
+        if i >= len(src):
+            o.append(("eof", None, s, i))
+            return o
+        m = (INNER if depth else OUTER).match(src, i)
+        if not m:  # leave it to the parser to tell what was expected
+            o.append(("?", src[i], s, i + 1))
+            i += 1
+            continue
+        kind, i = m.lastgroup, m.end()
+        if kind == "actor":
+            i = JUMP.match(src, i).end()
+            name = NAME.match(src, i)
+            i = name.end() if name else i
+            if not name or not src.startswith(">", i):
+                got = src[i] if i < len(src) else "EOF"
+                fail("", s.seek(i).get(got), expected="'>'" if name else "'actor'")
+            i += 1
+            o.append(("actor", name.group(), s, i))
+            continue
+        v = m.group()
+        if v == "[":
+            depth += 1
+        elif v == "]":
+            depth -= 1
+        o.append((kind, v, s, i))
+
+
+class stream:
+    __slots__ = ("toks", "i")
+
+    def __init__(self, toks, i=0):
+        self.toks = toks
+        self.i = i
+
+    @property
+    def tok(self):
+        return self.toks[self.i]
+
+    @property
+    def s(self):
+        return self.toks[self.i][2]
+
+    def peek(self, *vs):
+        kind, v, *_ = self.toks[self.i]
+        return kind == "sym" and v in vs
+
+    def accept(self, *vs):
+        if self.peek(*vs):
+            self.i += 1
+            return True
+        return False
+
+    def expect(self, *vs):
+        if self.peek(*vs):
+            self.i += 1
+            return self.toks[self.i - 1][1]
+        self.fail(" or ".join(f"'{v}'" for v in vs), closing=")" in vs or "]" in vs)
+
+    def take(self, kind, expected):
+        k, v, *_ = self.toks[self.i]
+        if k == kind:
+            self.i += 1
+            return v
+        self.fail(expected)
+
+    def fail(self, expected=None, reason="", closing=False):
+        kind, v, s, _ = self.toks[self.i]
+        got = "EOF" if kind == "eof" else v
+        if closing and self.i and s.line > self.toks[self.i - 1][2].line:
+            # unclosed bracket: point at where the line ended, not the next line
+            _, _, t, end = self.toks[self.i - 1]
+            s, got = t.seek(end), s.src[end : end + 1] or "EOF"
+        fail(reason, s.get(got), expected=expected)
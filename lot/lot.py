@@ -1,34 +1,77 @@
 import calendar
+import copy
+import glob
+import io
+import json
 import math
+import os
+import pickle
+import random
 import re
+import sys
+import threading
+import time
+import zlib
+from ast import literal_eval
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext, redirect_stdout
 from datetime import datetime
+from fractions import Fraction
 from unicodedata import east_asian_width
 
 import openpyxl
 from openpyxl.styles import Font, PatternFill
+import ortools
 from ortools.sat.python import cp_model
 
 from ouch import *
 
+from .cache import *
+from .lexer import *
 from .parser import *
+from .profiler import *
 
 TEMPERATURE = 0.1
 PENALTY_ENTROPY = 0.2
 PENALTY_SIGMA = 0.2
+SCALE = 1000  # weights of objective are integers scaled by this
+SIGMA_CUTS = 32  # tangents approximating squares beyond likely counts
 CUT_ACTOR_NAME = 4
+EXPORT_INTERVAL = 1.0  # least seconds between exports of incumbents
+
+# search profiles of solver: presolve is the number of presolve iterations
+# (0 to disable) and workers are search workers (0 to use all cores).
+SEARCH = {
+    "fast": dict(workers=8, time_limit=10, presolve=1, linearization=0),
+    "balanced": dict(workers=16, time_limit=60, presolve=3, linearization=1),
+    "thorough": dict(workers=0, time_limit=600, presolve=5, linearization=2),
+}
 
 
 # ----------------------
 # parse LOT source code
 # ----------------------
-def parse_lot(s):
-    _, s = jump(s)
-    g, s = parse_grid(s)
-    _, s = parse_bar(s)
-    a, s = parse_policy(s)
-    if s:
-        fail("Syntax Error: Invalid syntax used", s)
+def parse_lot(s, lexer=True, memo=True):
+    """
+    Parse LOT source code with the lexer, or else with the combinators,
+    memoizing them with 'memo'.
+
+    >>> with reader("examples/demo.lot", "r", encoding="utf-8") as f:
+    ...     src = f.read()
+    >>> o = parse_lot(src, lexer=False)
+    >>> o == parse_lot(src, lexer=False, memo=False) == parse_lot(src)
+    True
+    """
+    if lexer:
+        return scan_lot(stream(tokenize(s)))
+    with packrat() if memo else nullcontext():
+        _, s = jump(s)
+        g, s = parse_grid(s)
+        _, s = parse_bar(s)
+        a, s = parse_policy(s)
+        if s:
+            fail("Syntax Error: Invalid syntax used", s)
     return (g, dict(a)), s  # (grid, policy)
 
 
@@ -95,7 +138,7 @@ def parse_excl(s):
 def kwd(s):
     """
     >>> kwd("1-11;3")
-    (['1', '4', '7', '10'], '')
+    ([span(1, 11, 3)], '')
 
     >>> kwd("keyword")
     (['keyword'], '')
@@ -114,26 +157,26 @@ def kwd(s):
 def kwd_list(s):
     """
     >>> kwd_list("[1-3, 4, 5-11;3]")
-    (['1', '2', '3', '4', '5', '8', '11'], '')
+    ([span(1, 3), '4', span(5, 11, 3)], '')
     """
     r, s = squares(sepby(symbol(","), strip(kwd)))(s)
-    return nub(flatten(r)), s
+    return nub(concat(r)), s
 
 
 def kwd_tuple(s):
     """
     >>> kwd_tuple("(1-3, 4, 5-11;3)")
-    (['1', '2', '3', '4', '5', '8', '11'], '')
+    ([span(1, 3), '4', span(5, 11, 3)], '')
 
     >>> kwd_tuple("((1-3, 4, (5-11;3)))")
-    (['1', '2', '3', '4', '5', '8', '11'], '')
+    ([span(1, 3), '4', span(5, 11, 3)], '')
     """
     r, s = between(
         char("("),
         char(")"),
         sepby(symbol(","), choice(strip(kwd_tuple), strip(kwd))),
     )(s)
-    return nub(flatten(r)), s
+    return nub(concat(r)), s
 
 
 def xkwd(s):
@@ -142,10 +185,10 @@ def xkwd(s):
     ([['sofia']], '')
 
     >>> xkwd("(1-31;14):May:2025")
-    ([['1', '15', '29'], ['May'], ['2025']], '')
+    ([[span(1, 31, 14)], ['May'], ['2025']], '')
 
     >>> xkwd("((1-31;14):May:2025)")
-    ([['1', '15', '29'], ['May'], ['2025']], '')
+    ([[span(1, 31, 14)], ['May'], ['2025']], '')
     """
 
     def atom(s):
@@ -185,39 +228,316 @@ def expand(x):
     ['3']
 
     >>> expand("1-5")
-    ['1', '2', '3', '4', '5']
+    [span(1, 5)]
 
     >>> expand("2-10;3")
-    ['2', '5', '8']
+    [span(2, 10, 3)]
 
     >>> expand("5-1")
     []
     """
-    span = re.fullmatch(r"(\d+)\s*-\s*(\d+)", x)
-    if span:
-        return mapl(str, seq(*map(int, span.groups())))
-    step = re.fullmatch(r"(\d+)\s*-\s*(\d+)\s*;\s*(\d+)", x)
-    if step:
-        i, j, k = map(int, step.groups())
-        return mapl(str, seq(i, i + k, j))
+    m = re.fullmatch(r"(\d+)\s*-\s*(\d+)(?:\s*;\s*(\d+))?", x)
+    if m:
+        i, j, k = m.groups()
+        o = span(int(i), int(j), int(k or 1))
+        return [o] if o else []
     return [x]
 
 
+class span:
+    """Range of numeric keywords from 'i' to 'j' by step 'k', kept symbolic.
+
+    >>> list(span(2, 10, 3))
+    ['2', '5', '8']
+
+    >>> "8" in span(2, 10, 3), "9" in span(2, 10, 3), "08" in span(2, 10, 3)
+    (True, False, False)
+    """
+
+    __slots__ = ("i", "j", "k")
+
+    def __init__(self, i, j, k=1):
+        self.i = i
+        self.j = j
+        self.k = k
+
+    def __iter__(self):
+        return map(str, range(self.i, self.j + 1, self.k))
+
+    def __len__(self):
+        return len(range(self.i, self.j + 1, self.k)) if self.k > 0 else 0
+
+    def __contains__(self, x):
+        if not x.isdigit():
+            return False
+        n = int(x)
+        return self.i <= n <= self.j and (n - self.i) % self.k == 0 and str(n) == x
+
+    def __eq__(self, o):
+        return isinstance(o, span) and (self.i, self.j, self.k) == (o.i, o.j, o.k)
+
+    def __hash__(self):
+        return hash((self.i, self.j, self.k))
+
+    def __getstate__(self):
+        return (self.i, self.j, self.k)
+
+    def __setstate__(self, x):
+        self.i, self.j, self.k = x
+
+    def __repr__(self):
+        k = f", {self.k}" if self.k != 1 else ""
+        return f"span({self.i}, {self.j}{k})"
+
+
+class kset:
+    """Set of keywords given by keywords and spans, tested without expansion.
+
+    >>> "15" in kset([span(1, 31, 14), "May"])
+    True
+
+    >>> list(kset([span(1, 3), "2", "May"]))
+    ['1', '2', '3', 'May']
+
+    >>> len({kset(["May", "2"]), kset(["2", "May"])})
+    1
+    """
+
+    __slots__ = ("keys", "spans")
+
+    def __init__(self, xs):
+        self.keys = {x: None for x in xs}  # keeps the order of keywords
+        self.spans = tuple(x for x in self.keys if isinstance(x, span))
+
+    def __iter__(self):
+        return iter(nub(flat(self.keys)))
+
+    def __contains__(self, x):
+        return x in self.keys or any(x in o for o in self.spans)
+
+    def __eq__(self, o):
+        return isinstance(o, kset) and self.keys == o.keys
+
+    def __hash__(self):
+        return hash(frozenset(self.keys))  # equal in any order
+
+    def __getstate__(self):
+        return tuple(self.keys)
+
+    def __setstate__(self, xs):
+        self.__init__(xs)
+
+    def __repr__(self):
+        return f"kset({list(self.keys)})"
+
+
 def normalize(r):
     """
-    >>> normalize([[['1','15','29'], ['May'], ['2025']]])
-    [('1', 'May', '2025'), ('15', 'May', '2025'), ('29', 'May', '2025')]
+    >>> normalize([[[span(1, 31, 14)], ['May'], ['2025']]])
+    [(kset([span(1, 31, 14)]), kset(['May']), kset(['2025']))]
 
     >>> normalize([('#', [(['maria'], ['yoajung']), '>', '3'])])
-    [('#', (('maria', 'yoajung'), '>', '3'))]
+    [('#', ((kset(['maria']), kset(['yoajung'])), '>', '3'))]
     """
     o = []
     for x in r:
         if fst(x) == "#":
             key, sym, val = snd(x)
-            o.append(("#", (fst(cartprodl(*key)), sym, val)))
+            # only the first keyword of each group counts in a relation
+            key = tuple(kset([fst(flat(c))]) for c in key)
+            o.append(("#", (key, sym, val)))
         else:
-            o.extend(cartprodl(*x))
+            o.append(tuple(map(kset, x)))
+    return o
+
+
+# ------------------------------------------
+# parse LOT from token stream (regex lexer)
+# ------------------------------------------
+def scan_lot(ts):
+    g = scan_grid(ts)
+    ts.take("bar", "'---'")
+    a = scan_policy(ts)
+    if ts.tok[0] != "eof":
+        fail("Syntax Error: Invalid syntax used", ts.s)
+    return (g, dict(a)), ts.s  # (grid, policy)
+
+
+def scan_grid(ts):
+    def line():
+        o = [scan_kwd_list(ts)]
+        while ts.peek("["):
+            o.append(scan_kwd_list(ts))
+        return o
+
+    g = [line()]
+    while ts.accept("+"):
+        g.append(line())
+    return g
+
+
+def scan_policy(ts):
+    def unit():
+        a = ts.take("actor", "'<'")
+        q = []
+        while ts.peek("@", "/"):
+            q.append((ts.expect("@", "/"), ts.take("digits", "'digit'")))
+        r = []
+        while ts.accept("-"):
+            r.append(scan_pref(ts))
+        r.extend(q)
+        return a, r  # (actor, preferences)
+
+    o = [unit()]
+    while ts.tok[0] == "actor":
+        o.append(unit())
+    return o
+
+
+def scan_pref(ts):
+    sym = ts.expect("X", "x", "O", "o", "!").lower()
+    p = scan_rexpr if sym == "o" else scan_xkwd
+    ts.expect("[")
+    r = [p(ts)]
+    while ts.accept(","):
+        r.append(p(ts))
+    ts.expect("]")
+    return sym, normalize(r)  # (x|o|!, [xkwd,...])
+
+
+def scan_kwd(ts):
+    s = ts.s
+    x = expand(ts.take("kwd", "'keyword-char'"))
+    if not x:
+        fail("Invalid keyword expression", s)
+    return x
+
+
+def scan_kwd_list(ts):
+    """
+    >>> scan_kwd_list(stream(tokenize("[1-3, 4, 5-11;3]")))
+    [span(1, 3), '4', span(5, 11, 3)]
+    """
+    ts.expect("[")
+    r = [scan_kwd(ts)]
+    while ts.accept(","):
+        r.append(scan_kwd(ts))
+    ts.expect("]")
+    return nub(concat(r))
+
+
+def scan_kwd_tuple(ts):
+    def key():
+        return scan_kwd_tuple(ts) if ts.peek("(") else scan_kwd(ts)
+
+    ts.expect("(")
+    r = [key()]
+    while ts.accept(","):
+        r.append(key())
+    ts.expect(")")
+    return nub(concat(r))
+
+
+def scan_xkwd(ts):
+    """
+    >>> scan_xkwd(stream(tokenize("[(1-31;14):May:2025]")[1:]))
+    [[span(1, 31, 14)], ['May'], ['2025']]
+
+    >>> scan_xkwd(stream(tokenize("[((1-31;14):May:2025)]")[1:]))
+    [[span(1, 31, 14)], ['May'], ['2025']]
+    """
+
+    def atom():
+        r = [scan_kwd_tuple(ts) if ts.peek("(") else scan_kwd(ts)]
+        while ts.accept(":"):
+            r.append(scan_kwd_tuple(ts) if ts.peek("(") else scan_kwd(ts))
+        return r
+
+    i = ts.i
+    try:
+        return atom()
+    except ParseError as e:
+        ts.i = i
+        if not ts.accept("("):
+            raise
+        try:
+            r = scan_xkwd(ts)
+            ts.expect(")")
+            return r
+        except ParseError as f:
+            raise f if f.s > e.s else e
+
+
+def scan_rexpr(ts):
+    """
+    >>> scan_rexpr(stream(tokenize("[sofia >= 10]")[1:]))
+    ('#', [(['sofia'],), '>=', '10'])
+    """
+    k = scan_xkwd(ts)
+    if not ts.peek("<=", ">=", "=", "<", ">"):
+        return k
+    sym = ts.expect("<=", ">=", "=", "<", ">")
+    s = ts.s
+    val = ts.take("kwd", "'digit'")
+    if not re.fullmatch(r"[0-9]+", val):
+        fail("", s.get(val), expected="'digit'")
+    return "#", [tuple(k), sym, val]
+
+
+def split_lot(lines):
+    """
+    Split lines of LOT source code, such as an open file, into the grid block
+    followed by one block per actor unit, as (kind, line number, text).
+    Only one block is held in memory at a time.
+
+    >>> src = "[a] + [b]\\n---\\n<x>\\n- X [a]\\n\\n<y> @1\\n"
+    >>> [(k, n) for k, n, _ in split_lot(src.splitlines(keepends=True))]
+    [('grid', 1), ('unit', 2), ('unit', 6)]
+    """
+
+    def bar(x, depth):
+        for m in re.finditer(r"\[|\]|-{3,}", x):
+            if m.group() == "[":
+                depth += 1
+            elif m.group() == "]":
+                depth -= 1
+            elif not depth:
+                return m.span()
+
+    kind, start, buf, code, depth, units = "grid", 1, [], False, 0, 0
+    for n, line in enumerate(lines, 1):
+        x = line.split("#", 1)[0]
+        if kind == "grid":
+            span = bar(x, depth)
+            if span:
+                buf.append(line[: fst(span)])
+                yield kind, start, "".join(buf)
+                # blank out what is read so that columns stay intact
+                line = re.sub(r"[^\t]", " ", line[: snd(span)]) + line[snd(span) :]
+                x = line.split("#", 1)[0]
+                kind, start, buf, code, depth = "unit", n, [], False, 0
+        elif not depth and code and x.lstrip().startswith("<"):
+            yield kind, start, "".join(buf)
+            start, buf, code, units = n, [], False, units + 1
+        buf.append(line)
+        code = code or bool(x.strip())
+        depth += x.count("[") - x.count("]")
+    if kind == "grid":
+        yield "lot", 1, "".join(buf)  # never reached the bar
+    elif code or not units:
+        yield kind, start, "".join(buf)
+
+
+def scan_block(kind, line, text):
+    ts = stream(tokenize(state(text, line=line)))
+    if kind == "unit":
+        o = scan_policy(ts)
+        if ts.tok[0] != "eof":
+            fail("Syntax Error: Invalid syntax used", ts.s)
+    else:
+        o = scan_grid(ts)
+        if kind == "lot" or ts.tok[0] != "eof":
+            ts.fail("'---'")
     return o
 
 
@@ -227,82 +547,610 @@ def normalize(r):
 #      nodes | cartprod(grid)            ;; junctions of grid
 #     policy | { actor: [preference] }   ;; actor's requests
 #     actors | policy.keys()             ;; target group
-#        act | (actor, *node)            ;; unique id in vars
-#       vars | { act: model.boolvar }    ;; model variables
-#     coeffs | { act: float }            ;; weights of availability
+#        act | a * len(nodes) + i        ;; (actor, node) ids in vars
+#       vars | table([model.boolvar])    ;; model variables, actor-major
+#            |                           ;; None for acts never allowed
+#     coeffs | [float]                   ;; weights of availability
 #  objective | sum(coeffs[act] * vars[act], ...)
 # ---------------------------------------------------------------------
 
 
-def solve(args):
-    s = reader(args.FILE, "r", encoding="utf-8").read()
-    (grid, policy), _ = parse_lot(s)
-    validate_policy(grid, policy)
-    nodes = gen_nodes(grid)
-    rmap = gen_rmap(nodes)
-    actors = policy.keys()
-    rest = {actor: args.min_rest or 0 for actor in actors}
-    consts = dict(
-        grid=grid,
-        policy=policy,
-        nodes=nodes,
-        actors=actors,
-        rmap=rmap,
-        rest=rest,
+def solve(args, consts=None):
+    if args.block:
+        ignored = [
+            f"--{k.replace('_', '-')}"
+            for k in ("min_cap", "hint", "anytime", "export")
+            if getattr(args, k, None)
+        ]
+        if ignored:
+            error(
+                f"Error, --block cannot be used with {', '.join(ignored)}", e=Exception
+            )
+    with profiling(getattr(args, "profile", None), getattr(args, "pstats", None)):
+        consts = consts or load_lot(args.FILE, cache=not args.no_cache)
+        actors = consts["policy"].keys()
+        rest = {actor: args.min_rest or 0 for actor in actors}
+        consts.update(actors=actors, rest=rest)
+        params = search_params(args)
+        consts.update(search=params)
+        start = time.monotonic()
+
+        # schedules of the same inputs are read from disk without solving again
+        db = None if args.no_cache or getattr(args, "export", None) else store("solve")
+        hint = None
+        if db and args.hint:
+            with reader(args.hint, "rb") as f:
+                hint = f.read()
+        key = digest(
+            consts["grid"],
+            sorted(consts["policy"].items()),
+            args.min_rest or 0,
+            args.max_it or 5,
+            sorted(params.items()),
+            args.min_cap,
+            args.block,
+            args.engine,
+            hint,
+        )
+        o = db.get(key) if db else None
+        if o is None:
+            if params.get("seed") is not None:
+                random.seed(params["seed"])
+            if args.block:
+                with phase("solve_by_blocks"):
+                    o = solve_by_blocks(args, consts, start)
+            else:
+                o = solve_model(args, consts, start)
+            # schedules stopped short of optimal by a time limit or SIGINT
+            # would be replayed as if complete
+            if db and not consts.get("interrupted"):
+                try:
+                    db.put(key, o)
+                    db.evict()
+                except Exception as e:  # never lose a schedule to the cache
+                    print(f"Warning, schedule not cached: {e}", file=sys.stderr)
+        report_and_export(consts, o, args)
+        return o
+
+
+# options naming files of each run, given once for all files of a batch
+BATCH_PATHS = ("output", "dump", "hint", "export", "profile", "pstats")
+
+
+def solve_batch(args):
+    """
+    Solve each file of 'args.FILE', files or globs, in a pool of 'args.jobs'
+    processes sharing out 'args.workers' search workers among them, then
+    print a summary. All files are parsed up front, and a file failing to
+    parse or solve is reported without stopping the others.
+    """
+    files = list(
+        dict.fromkeys(
+            os.path.normpath(f)
+            for x in args.FILE
+            for f in (sorted(glob.glob(x)) or [x])
+        )
     )
+    jobs = min(args.jobs or os.cpu_count(), len(files))
+    workers = max(1, (args.workers or os.cpu_count()) // jobs)
+    tasks, done = [], {}
+    for f in files:
+        start = time.monotonic()
+        try:
+            consts = load_lot(f, cache=not args.no_cache)
+        except Exception as e:
+            status = f"failed: {e}".splitlines()[0]
+            done[f] = dict(status=status, parse=time.monotonic() - start)
+            continue
+        parsed = time.monotonic() - start
+        o = copy.copy(args)
+        o.FILE, o.workers = f, workers
+        for k in BATCH_PATHS:
+            if getattr(o, k, None):
+                setattr(o, k, batch_path(getattr(o, k), f))
+        tasks.append((f, o, consts, parsed))
+
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = {pool.submit(solve_quietly, o, c): (f, c, t) for f, o, c, t in tasks}
+        for x in as_completed(futures):
+            f, consts, parsed = futures[x]
+            try:
+                status, out, sec = x.result()
+            except Exception as e:  # such as a worker killed
+                status, out, sec = f"failed: {e}", "", None
+            sys.stdout.write(out)
+            done[f] = dict(
+                status=status,
+                nodes=len(consts["nodes"]),
+                actors=len(consts["policy"]),
+                parse=parsed,
+                solve=sec,
+            )
+    report_batch(files, done)
+    return done
+
+
+def batch_path(path, f):
+    """
+    Path of an output of input 'f' in a batch, named after both
+
+    >>> batch_path("out/roster.xlsx", "sites/north.lot")
+    'out/roster-north.xlsx'
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}-{os.path.splitext(os.path.basename(f))[0]}{ext}"
+
+
+def solve_quietly(args, consts):
+    """Solve a file of a batch, returning its status, output and seconds"""
+    out, start = io.StringIO(), time.monotonic()
+    try:
+        with redirect_stdout(out):
+            solve(args, consts)
+        status = "solved"
+    except Exception as e:
+        status = f"failed: {e}".splitlines()[0]
+    return status, out.getvalue(), time.monotonic() - start
+
+
+def report_batch(files, done):
+    def sec(x):
+        return "-" if x is None else f"{x:.2f}s"
+
+    c = max(len(f) for f in files) + 2
+    print()
+    print(f"{'FILE':<{c}}{'nodes':>7}{'actors':>8}{'parse':>9}{'solve':>9}  STATUS")
+    for f in files:
+        d = done[f]
+        print(
+            f"{f:<{c}}{d.get('nodes', '-'):>7}{d.get('actors', '-'):>8}"
+            f"{sec(d.get('parse')):>9}{sec(d.get('solve')):>9}  {d['status']}"
+        )
+    failed = sum(d["status"] != "solved" for d in done.values())
+    print(f"\n{len(files) - failed} solved, {failed} failed")
+
+
+def solve_model(args, consts, start):
+    nodes, actors = consts["nodes"], consts["actors"]
     max_acts = len(nodes) // len(actors) or 1
     max_it = args.max_it or 5
+    params = consts["search"]
+
+    def new_solver():
+        return gen_solver(params, time_left(params, start))
+
+    # build the model once: retries only move the bound of 'cap'
+    export = getattr(args, "export", None)  # named variables to be read by people
+    model, vars, coeffs, cap, penalty = build_model(consts, args.engine, bool(export))
+    if export:
+        with writer(export, "wb") as f:
+            o = dump_model(model, vars, coeffs, cap, penalty)
+            pickle.dump(o, f, protocol=pickle.HIGHEST_PROTOCOL)
+    set_objective(model, vars, coeffs, consts, penalty)
+    record_model(model)
+    if args.hint:
+        set_hints(model, vars, read_hints(args.hint, vars))
+
+    if args.min_cap:
+        # find the least cap in one run first, then optimize preferences under it
+        cap.with_domain(cp_model.Domain(-(-len(nodes) // len(actors)), len(nodes)))
+        model.minimize(cap)
+        solver = new_solver()
+        with phase("solve"):
+            status = solver.solve(model)
+        record_solve(solver, status, stage="min_cap")
+        if status == cp_model.INFEASIBLE:
+            error("Aborted. No cap of acts per actor is feasible", e=Exception)
+        if status not in (cp_model.FEASIBLE, cp_model.OPTIMAL):
+            error("Aborted. Time limit reached before any cap", e=Exception)
+        max_acts = solver.value(cap)
+        set_hints(model, vars, vars.values(solver))
+        set_objective(model, vars, coeffs, consts, penalty)
+
+    anytime = (
+        incumbent(vars, coeffs, consts, args, start)
+        if getattr(args, "anytime", None)
+        else None
+    )
     it = 0
     while True:
-        model = cp_model.CpModel()
-        vars = gen_vars(model, consts)
-        coeffs = process_policy(model, vars, consts)
-        rule_single_actor_per_node(model, vars, consts)
-        rule_at_most_one_act_per_root(model, vars, consts)
-        rule_clip_acts_per_actor(model, vars, consts, max_acts)
-        rule_rest_between_acts(model, vars, consts)
-
-        solver = cp_model.CpSolver()
-        set_objective(model, vars, coeffs, consts)
-        if solver.solve(model) in (cp_model.FEASIBLE, cp_model.OPTIMAL):
+        if anytime and anytime.o and out_of_time(params, start):
+            consts["interrupted"] = True  # cut short by the deadline
+            return anytime.o
+        cap.with_domain(cp_model.Domain(max_acts, max_acts))
+        solver = new_solver()
+        with phase("solve"):
+            if anytime:
+                status = solve_interruptible(solver, model, anytime)
+            else:
+                status = solver.solve(model)
+        record_solve(solver, status, iteration=it, cap=max_acts)
+        if anytime and anytime.stopped:
+            consts["interrupted"] = True
+            if anytime.o is None:
+                error("Aborted. Interrupted before any schedule", e=Exception)
+            return anytime.o
+        if status in (cp_model.FEASIBLE, cp_model.OPTIMAL):
             o = collect_results(solver, vars, coeffs, consts)
             if valid_results(consts, o):
-                report_and_export(consts, o, args)
-                break
+                if status != cp_model.OPTIMAL:  # stopped by a time limit
+                    consts["interrupted"] = True
+                return o
             else:
+                # redraw the noise and search again from this solution
+                set_hints(model, vars, vars.values(solver))
+                set_objective(model, vars, coeffs, consts, penalty)
                 continue
+        if status == cp_model.UNKNOWN:  # a larger cap would not help
+            error(
+                f"Aborted. Time limit reached before any schedule of cap {max_acts}",
+                e=Exception,
+            )
         if it > max_it:
             error(f"Aborted. Exceeded maximum iterations: {max_it}", e=Exception)
         max_acts += 1
         it += 1
 
 
+def search_params(args):
+    """
+    Parameters of search from a profile, a conf file and the options given,
+    in increasing order of precedence. Keys of the conf file are the long
+    options, such as 'search', 'workers' or 'time-limit', with either
+    hyphens or underscores.
+    """
+    keys = (
+        "workers",
+        "time_limit",
+        "deadline",
+        "presolve",
+        "linearization",
+        "log",
+        "seed",
+    )
+
+    def value(x):
+        try:
+            return literal_eval(x)
+        except (ValueError, SyntaxError):
+            return x  # bare words such as profile names
+
+    conf = (
+        {
+            k.replace("-", "_"): value(v)
+            for k, v in read_conf(args.conf, o=False).items()
+        }
+        if getattr(args, "conf", None)
+        else {}
+    )
+    unknown = sorted(set(conf) - {"search", *keys})
+    if unknown:
+        error(
+            f"Error, no such search parameters in {args.conf}: {', '.join(unknown)}",
+            e=Exception,
+        )
+    name = getattr(args, "search", None) or conf.get("search")
+    if name and name not in SEARCH:
+        error(f"Error, no such search profile: {name}", e=Exception)
+    o = dict(search=name or "default", **SEARCH.get(name, {}))
+    for k in keys:
+        x = getattr(args, k, None)
+        x = conf.get(k) if x is None else x
+        if x is not None:
+            o[k] = x
+    return o
+
+
+class incumbent(cp_model.CpSolverSolutionCallback):
+    """
+    Keep the latest valid schedule found while solving, printing a line of
+    its objective, bound, gap and elapsed time to stderr, and saving it to
+    the output files of 'args' at most every 'EXPORT_INTERVAL' seconds.
+    """
+
+    def __init__(self, vars, coeffs, consts, args, start):
+        super().__init__()
+        self.vars = vars
+        self.coeffs = coeffs
+        self.consts = consts
+        self.args = args
+        self.start = start
+        self.o = None
+        self.stopped = False
+        self.saved = -math.inf
+
+    def on_solution_callback(self):
+        o = collect_results(self, self.vars, self.coeffs, self.consts)
+        if not valid_results(self.consts, o):
+            return
+        self.o = o
+        obj, bound = self.objective_value / SCALE, self.best_objective_bound / SCALE
+        gap = abs(bound - obj) / max(abs(obj), 1e-9)
+        now = time.monotonic()
+        print(
+            f"objective {obj:>12.3f}  bound {bound:>12.3f}  "
+            f"gap {gap:>8.2%}  {now - self.start:>8.2f}s",
+            file=sys.stderr,
+            flush=True,
+        )
+        if now - self.saved >= EXPORT_INTERVAL:
+            report_and_export(self.consts, o, self.args, show=False)
+            self.saved = now
+
+
+def solve_interruptible(solver, model, callback):
+    """
+    Solve 'model' in a thread, so that SIGINT stops the search gracefully
+    and marks 'callback' as stopped instead of discarding its incumbent.
+    """
+    solver.parameters.catch_sigint_signal = False
+    o, done = {}, threading.Event()
+
+    def run():
+        try:
+            o["status"] = solver.solve(model, callback)
+        finally:
+            done.set()
+
+    t = threading.Thread(target=run)
+    t.start()
+    try:
+        while not done.wait(0.1):  # an interrupted 'join' may not wait again
+            pass
+    except KeyboardInterrupt:
+        callback.stopped = True
+        solver.stop_search()
+        done.wait()
+    t.join()
+    return o.get("status", cp_model.UNKNOWN)
+
+
+def out_of_time(params, start):
+    return (
+        params.get("deadline") is not None
+        and time.monotonic() - start >= params["deadline"]
+    )
+
+
+def time_left(params, start):
+    if params.get("deadline") is None:
+        return None
+    budget = params["deadline"] - (time.monotonic() - start)
+    if budget <= 0:
+        error(f"Aborted. Exceeded deadline: {params['deadline']}s", e=Exception)
+    return budget
+
+
+def gen_solver(params, budget=None):
+    solver = cp_model.CpSolver()
+    p = solver.parameters
+    if params.get("workers") is not None:
+        p.num_workers = params["workers"]
+    limits = [x for x in (params.get("time_limit"), budget) if x is not None]
+    if limits:
+        p.max_time_in_seconds = min(limits)
+    if params.get("presolve") is not None:
+        p.cp_model_presolve = params["presolve"] > 0
+        p.max_presolve_iterations = max(params["presolve"], 1)
+    if params.get("linearization") is not None:
+        p.linearization_level = params["linearization"]
+    if params.get("log"):
+        p.log_search_progress = True
+    if params.get("seed") is not None:
+        p.random_seed = params["seed"]
+    watch(solver)
+    return solver
+
+
+def load_lot(f, cache=True):
+    """
+    Read LOT source code from file 'f' block by block, validating and
+    compiling each actor's preferences as its block arrives, and compile
+    the grid into nodes. With 'cache', the grid block and each actor block
+    are looked up on disk by the hash of their text, so only the changed
+    blocks are parsed and validated again.
+    """
+    db = store("parse") if cache else None
+
+    def cached(key, compile, *args):
+        o = db.get(key) if db else None
+        if o is None:
+            o = compile(*args)
+            if db:
+                db.put(key, o)
+        return o
+
+    def compile_grid(kind, line, text):
+        with phase("parse_lot"):
+            grid = scan_block(kind, line, text)
+        with phase("gen_nodes"):
+            nodes = gen_nodes(grid)
+            return grid, nodes, gen_rmap(nodes), gen_index(nodes)
+
+    def compile_units(keys, line, text):
+        with phase("parse_lot"):
+            units = [(a, r, read_prefs(r)) for a, r in scan_block("unit", line, text)]
+        with phase("validate_policy"):
+            return units, [x for a, _, d in units for x in invalid_keys(keys, a, d)]
+
+    with reader(f, "r", encoding="utf-8") as fh:
+        blocks = timed("read", split_lot(fh))
+        kind, line, text = next(blocks)
+        key = digest(kind, text)
+        grid, nodes, rmap, index = cached(key, compile_grid, kind, line, text)
+        keys = set(flat(grid))
+        policy, prefs, found = {}, {}, []
+        for _, line, text in blocks:
+            units, invalid = cached(digest(key, text), compile_units, keys, line, text)
+            found.extend(invalid)
+            for actor, r, d in units:
+                policy[actor] = r
+                prefs[actor] = d
+    if found:
+        report_invalid_keys(found)
+    if db:
+        db.evict()
+    return dict(
+        grid=grid, policy=policy, prefs=prefs, nodes=nodes, rmap=rmap, index=index
+    )
+
+
 def gen_nodes(grid):
-    return cf_(dsort, concat)(cartprod(*g) for g in grid)
+    return cf_(dsort, concat)(cartprod(*map(kset, g)) for g in grid)
 
 
 def gen_rmap(nodes):
     rmap = {}
-    for node in nodes:
+    for i, node in enumerate(nodes):
         r = fst(node)
         if r in rmap:
-            rmap[r].append(node)
+            rmap[r].append(i)
         else:
-            rmap[r] = [node]
+            rmap[r] = [i]
     return rmap
 
 
-def gen_vars(model, consts):
-    vars = {}
-    for actor in consts["actors"]:
-        for node in consts["nodes"]:
-            act = (actor, *node)
-            vars[act] = model.new_bool_var("_".join(act))
-    return vars
+def gen_index(nodes):
+    """
+    Map each keyword to the bitset of nodes containing it, where the node
+    at position 'i' in 'nodes' is the bit 'i'.
+
+    >>> gen_index([("1", "a"), ("1", "b"), ("2", "a")])
+    {'1': 3, 'a': 5, 'b': 2, '2': 4}
+    """
+    index = {}
+    for i, node in enumerate(nodes):
+        for k in node:
+            index[k] = index.get(k, 0) | 1 << i
+    return index
+
+
+def match_index(index, prefs):
+    """
+    Bitset of nodes matching any of preferences, intersecting the bitsets
+    of keywords within each preference.
+
+    >>> index = gen_index([("1", "a"), ("1", "b"), ("2", "a")])
+    >>> match_index(index, [(kset(["1"]), kset(["a"])), (kset([span(2, 3)]),)])
+    5
+    """
+
+    def group(c):
+        o = 0
+        for k in c.keys:
+            o |= index.get(k, 0)
+        for x in c.spans:
+            for k in x if len(x) < len(index) else index:
+                if k in x:
+                    o |= index.get(k, 0)
+        return o
+
+    o = 0
+    for pref in prefs:
+        m = -1
+        for c in pref:
+            m &= group(c)
+            if not m:
+                break
+        o |= m
+    return o
 
 
-def match_node(prefs, node):
-    return any(set(o).issubset(set(node)) for o in prefs)
+def bits(x):
+    """
+    >>> list(bits(0b10110))
+    [1, 2, 4]
+    """
+    while x:
+        b = x & -x
+        yield b.bit_length() - 1
+        x ^= b
+
+
+@phased
+def gen_vars(model, consts, names=False):
+    actors, nodes = list(consts["actors"]), consts["nodes"]
+    allowed = gen_allowed(consts)
+    return table(
+        actors,
+        nodes,
+        [
+            (
+                model.new_bool_var("_".join((actor, *node)) if names else "")
+                if m >> i & 1
+                else None
+            )
+            for actor, m in zip(actors, allowed)
+            for i, node in enumerate(nodes)
+        ],
+    )
+
+
+def gen_allowed(consts):
+    """
+    Bitsets of nodes each actor may take: all nodes but those matched by
+    its X-preferences and those forbidden to it.
+
+    >>> consts = dict(actors=["sofia"], nodes=[("1", "a"), ("2", "a")])
+    >>> consts.update(forbid={0: [1]})
+    >>> gen_allowed(consts)
+    [1]
+    """
+    prefs, forbid = consts.get("prefs", {}), consts.get("forbid", {})
+    full = (1 << len(consts["nodes"])) - 1
+    o = []
+    for a, actor in enumerate(consts["actors"]):
+        x = sum(1 << i for i in forbid.get(a, ()))
+        if actor in prefs and prefs[actor]["x"]:
+            x |= match_index(consts["index"], prefs[actor]["x"])
+        o.append(full & ~x)
+    return o
+
+
+class table:
+    """Decision variables of actors by nodes, stored in a flat actor-major list.
+
+    Actors and nodes are referred to by their positions: the variable of
+    actor 'a' on node 'i' is 'vars[a * len(nodes) + i]', or None when the
+    actor may never take the node. Rows and columns leave out such ones.
+
+    >>> consts = dict(actors=["sofia", "maria"], nodes=[("1", "a"), ("2", "a")])
+    >>> consts.update(forbid={0: [0]})
+    >>> t = gen_vars(cp_model.CpModel(), consts, names=True)
+    >>> t.row(1)[0].name, t.col(1)[0].name, t.act(3)
+    ('maria_1_a', 'sofia_2_a', ('maria', '2', 'a'))
+    >>> len(t), len(t.row(0)), len(t.col(0))
+    (4, 1, 1)
+    """
+
+    __slots__ = ("actors", "nodes", "vars")
+
+    def __init__(self, actors, nodes, vars):
+        self.actors = actors
+        self.nodes = nodes
+        self.vars = vars
+
+    def row(self, a):
+        n = len(self.nodes)
+        return [v for v in self.vars[a * n : (a + 1) * n] if v is not None]
+
+    def col(self, i):
+        return [v for v in self.vars[i :: len(self.nodes)] if v is not None]
+
+    def take(self, a, ids):
+        """Variables of actor 'a' on nodes of 'ids'"""
+        k = a * len(self.nodes)
+        return [self.vars[k + i] for i in ids if self.vars[k + i] is not None]
+
+    def values(self, solver):
+        return [v is not None and solver.boolean_value(v) for v in self.vars]
+
+    def act(self, k):
+        a, i = divmod(k, len(self.nodes))
+        return (self.actors[a], *self.nodes[i])
+
+    def __len__(self):
+        return len(self.vars)
 
 
 def dsort(x):
@@ -339,57 +1187,131 @@ def validate_policy(grid, policy):
     keys = set(flat(grid))
     found = []
     for actor, prefs in policy.items():
-        d = read_prefs(prefs)
-        for k in flat(d["o"], d["x"], d["!"]):
-            if k not in keys:
-                found.append((k, actor))
+        found.extend(invalid_keys(keys, actor, read_prefs(prefs)))
     if found:
-        out = ["Invalid keywords", ""]
-        for k, actor in found:
-            out.append(f"    '{k}', from <{actor}>")
-        out.append("")
-        out.append(f"Found {len(found)} error(s).")
-        error(unlines(out), e=Exception)
+        report_invalid_keys(found)
+
 
+def invalid_keys(keys, actor, d):
+    return [(k, actor) for k in flat(d["o"], d["x"], d["!"]) if k not in keys]
 
+
+def report_invalid_keys(found):
+    out = ["Invalid keywords", ""]
+    for k, actor in found:
+        out.append(f"    '{k}', from <{actor}>")
+    out.append("")
+    out.append(f"Found {len(found)} error(s).")
+    error(unlines(out), e=Exception)
+
+
+@phased
 def process_policy(model, vars, consts):
-    coeffs = {}
-    for actor, prefs in consts["policy"].items():
-        d = read_prefs(prefs)
+    nodes, index = consts["nodes"], consts["index"]
+    n = len(nodes)
+    coeffs = [0] * len(vars)
+    for a, actor in enumerate(vars.actors):
+        d = consts["prefs"][actor]
         # process @acts if any
         if d["@"]:
-            model.add(
-                sum(vars[(actor, *node)] for node in consts["nodes"]) == d["@"],
-            )
+            model.add(cp_model.LinearExpr.sum(vars.row(a)) == d["@"])
         # update /rest if any
         if not isinstance(d["/"], list):
             consts["rest"][actor] = d["/"]
         # process q-preference
         for key, sym, val in d["q"]:
-            lhs = sum(
-                vars[(actor, *node)]
-                for node in consts["nodes"]
-                if match_node([key], node)
-            )
-            model.add(expr(sym, lhs, int(val)))
-        # process o/x preference
-        for node in consts["nodes"]:
-            act = (actor, *node)
-            coeffs[act] = 1 if not d["o"] or match_node(d["o"], node) else 0
-            if match_node(d["x"], node):
-                model.add(vars[act] == 0)
+            lhs = vars.take(a, bits(match_index(index, [key])))
+            model.add(expr(sym, cp_model.LinearExpr.sum(lhs), int(val)))
+        # process o-preference: x-preference leaves no variables to pin
+        o = match_index(index, d["o"]) if d["o"] else (1 << n) - 1
+        for i in bits(o):
+            coeffs[a * n + i] = 1
         # update priority
         if d["!"]:
             precedence = zipl(d["!"], w_priority(len(d["!"])))
             for el, w in precedence:
-                for node in consts["nodes"]:
-                    if set(el).issubset(set(node)):
-                        act = (actor, *node)
-                        if coeffs[act]:
-                            coeffs[act] += w
+                for i in bits(match_index(index, [el]) & o):
+                    coeffs[a * n + i] += w
+    return coeffs
+
+
+@phased
+def process_policy_np(model, vars, consts):
+    """
+    Same as 'process_policy', but computes the coefficients and the masks
+    of matching nodes with array operations over the incidence matrix.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        error(
+            "Error, the numpy engine needs numpy: pip install lot[numpy]", e=Exception
+        )
+    nodes = consts["nodes"]
+    coeffs = [0] * len(vars)
+    if "incidence" not in consts:
+        consts["incidence"] = gen_incidence(nodes, list(consts["index"]))
+    keys, inc = consts["incidence"]
+    ids = {k: j for j, k in enumerate(keys)}
+    nums = np.array([int(k) if k.isdigit() and str(int(k)) == k else -1 for k in keys])
+
+    def group(c):
+        m = np.zeros(len(keys), dtype=bool)
+        m[[ids[k] for k in c.keys if k in ids]] = True
+        for x in c.spans:
+            m |= (nums >= x.i) & (nums <= x.j) & ((nums - x.i) % x.k == 0)
+        return m
+
+    def match(prefs):
+        o = np.zeros(len(nodes), dtype=bool)
+        for pref in prefs:
+            m = np.ones(len(nodes), dtype=bool)
+            for c in pref:
+                m &= inc[group(c)].any(0)
+            o |= m
+        return o
+
+    for a, actor in enumerate(vars.actors):
+        d = consts["prefs"][actor]
+        # process @acts if any
+        if d["@"]:
+            model.add(cp_model.LinearExpr.sum(vars.row(a)) == d["@"])
+        # update /rest if any
+        if not isinstance(d["/"], list):
+            consts["rest"][actor] = d["/"]
+        # process q-preference
+        for key, sym, val in d["q"]:
+            lhs = vars.take(a, np.flatnonzero(match([key])))
+            model.add(expr(sym, cp_model.LinearExpr.sum(lhs), int(val)))
+        # process o-preference: x-preference leaves no variables to pin
+        o = match(d["o"]) if d["o"] else np.ones(len(nodes), dtype=bool)
+        # update priority
+        w = o.astype(float)
+        if d["!"]:
+            els = np.array([match([el]) for el in d["!"]])
+            w += (np.array(w_priority(len(d["!"]))) @ els) * o
+        coeffs[a * len(nodes) : (a + 1) * len(nodes)] = w.tolist()
     return coeffs
 
 
+def gen_incidence(nodes, keys):
+    """
+    Boolean matrix of keywords by nodes, true where a node has a keyword.
+
+    >>> keys, inc = gen_incidence([("1", "a"), ("2", "a")], ["1", "a", "2"])
+    >>> inc.astype(int).tolist()
+    [[1, 0], [1, 1], [0, 1]]
+    """
+    import numpy as np
+
+    ids = {k: j for j, k in enumerate(keys)}
+    inc = np.zeros((len(keys), len(nodes)), dtype=bool)
+    rows = [ids[k] for node in nodes for k in node]
+    cols = [i for i, node in enumerate(nodes) for _ in node]
+    inc[rows, cols] = True
+    return keys, inc
+
+
 def w_priority(n):
     if n < 1:
         return []
@@ -410,7 +1332,8 @@ def read_prefs(prefs):
         elif sym == "x":
             d[sym].extend(o)
         elif sym == "!":
-            d[sym] = o
+            # each combination of keywords takes its own rank of priority
+            d[sym] = [tuple(kset([k]) for k in x) for el in o for x in cartprod(*el)]
         elif sym in ["@", "/"]:
             d[sym] = int(o)
         else:
@@ -418,111 +1341,496 @@ def read_prefs(prefs):
     return d
 
 
+@phased
 def rule_single_actor_per_node(model, vars, consts):
-    for node in consts["nodes"]:
-        model.add(sum(vars[(actor, *node)] for actor in consts["actors"]) == 1)
+    for i in range(len(consts["nodes"])):
+        model.add_exactly_one(vars.col(i))
 
 
+@phased
 def rule_at_most_one_act_per_root(model, vars, consts):
-    root = cf_(uniq, fst, zip)(*consts["nodes"])
-    for actor in consts["actors"]:
-        for r in root:
-            model.add(sum(vars[(actor, *node)] for node in consts["rmap"][r]) <= 1)
+    rmap = consts["rmap"]
+    for a in range(len(vars.actors)):
+        for ids in rmap.values():
+            acts = vars.take(a, ids)
+            if len(acts) > 1:
+                model.add_at_most_one(acts)
 
 
+@phased
 def rule_clip_acts_per_actor(model, vars, consts, max_acts):
-    for actor in consts["actors"]:
-        acts = []
-        for node in consts["nodes"]:
-            act = (actor, *node)
-            acts.append(vars[act])
-        model.add(1 <= sum(acts))  # assign at least once per actor
-        model.add(sum(acts) <= max_acts)
+    for a in range(len(vars.actors)):
+        acts = cp_model.LinearExpr.sum(vars.row(a))
+        if consts.get("at_least_once", True):
+            model.add(1 <= acts)  # assign at least once per actor
+        model.add(acts <= (max_acts[a] if isinstance(max_acts, list) else max_acts))
 
 
+@phased
 def rule_rest_between_acts(model, vars, consts):
-    root = cf_(uniq, fst, zip)(*consts["nodes"])
-    for actor in consts["actors"]:
+    """
+    Keep at least '/rest' roots between acts of each actor: acts within any
+    window of 'rest + 1' consecutive roots are at most one.
+    """
+    ids = list(consts["rmap"].values())
+    for a, actor in enumerate(vars.actors):
         min_rest = consts["rest"][actor]
         if not min_rest:
             continue
-        for i, r in enumerate(root[:-min_rest]):
-            sched = model.new_bool_var(f"sched_{actor}_{r}")
-            model.add_bool_or(
-                [vars[(actor, *node)] for node in consts["rmap"][r]]
-            ).only_enforce_if(sched)
-            model.add_bool_and(
-                [vars[(actor, *node)].Not() for node in consts["rmap"][r]]
-            ).only_enforce_if(sched.Not())
-            for r_ in root[i + 1 : i + 1 + min_rest]:
-                for node in consts["rmap"][r_]:
-                    model.add(vars[(actor, *node)] == 0).only_enforce_if(sched)
-
-
-def set_objective(model, vars, coeffs, consts):
-    def add_noise(x):
-        return x + rand(TEMPERATURE) if x >= 1 else x
-
-    penalty_entropy = penalize_low_entropy(model, vars, consts)
-    penalty_sigma = penalize_high_sigma(model, vars, consts)
+        for i in range(max(1, len(ids) - min_rest)):
+            acts = vars.take(a, (j for w in ids[i : i + min_rest + 1] for j in w))
+            if len(acts) > 1:
+                model.add_at_most_one(acts)
+
+
+@phased
+def set_objective(model, vars, coeffs, consts, penalty=None):
+    def weight(x, e):
+        return round(SCALE * (x + e if x >= 1 else x))
+
+    if penalty is None:
+        penalty_entropy = penalize_low_entropy(model, vars, consts)
+        penalty_sigma = penalize_high_sigma(model, vars, consts)
+        penalty = penalty_entropy + penalty_sigma
+    ks = [k for k, v in enumerate(vars.vars) if v is not None]
+    noise = rand(TEMPERATURE, size=len(ks)) if ks else []
     model.maximize(
-        sum(
-            add_noise(coeffs[(actor, *node)]) * vars[(actor, *node)]
-            for actor in consts["actors"]
-            for node in consts["nodes"]
+        cp_model.LinearExpr.weighted_sum(
+            [vars.vars[k] for k in ks],
+            [weight(coeffs[k], e) for k, e in zip(ks, noise)],
         )
-        - penalty_entropy
-        - penalty_sigma
+        - penalty
     )
+    return penalty
 
 
+def set_hints(model, vars, values):
+    model.clear_hints()
+    for v, x in zip(vars.vars, values):
+        if v is not None:
+            model.add_hint(v, bool(x))
+
+
+def read_hints(f, vars):
+    """
+    Read a previous schedule from the "Nodes" sheet of a spreadsheet or
+    from a JSON dump of results, then return the values of 'vars' it sets.
+    Nodes filled by '*' or by actors no longer in policy are left unset.
+    """
+    if f.split(".")[-1] in ("xlsx", "xls"):
+        wb = openpyxl.load_workbook(f, read_only=True)
+        prev = {
+            node: actor for node, actor, *_ in wb["Nodes"].iter_rows(values_only=True)
+        }
+    else:
+        with reader(f, "r", encoding="utf-8") as fh:
+            prev = json.load(fh)["nodes"]
+    return [
+        prev.get(":".join(node)) == actor
+        for actor in vars.actors
+        for node in vars.nodes
+    ]
+
+
+@phased
 def penalize_low_entropy(model, vars, consts):
+    """
+    Penalize acts of an actor sharing a keyword by the number of them but
+    one. Keywords within a single root are skipped, as they are already
+    covered by 'rule_at_most_one_act_per_root'.
+    """
+    rmap = consts["rmap"]
+    root = {i: r for r, ids in rmap.items() for i in ids}
+    groups = [list(bits(x)) for x in consts["index"].values()]
+    groups = [ids for ids in groups if len({root[i] for i in ids}) > 1]
     penalties = []
-    d = defaultdict(list)
-    for node in consts["nodes"]:
-        for e in node:
-            d[e].append(node)
-    d = {k: v for k, v in d.items() if len(v) > 1}
-    for actor in consts["actors"]:
-        for _, nodes in d.items():
-            el_vars = [vars[(actor, *node)] for node in nodes]
+    for a in range(len(vars.actors)):
+        for ids in groups:
+            el_vars = vars.take(a, ids)
+            if len(el_vars) < 2:
+                continue
             penalty = model.new_int_var(0, len(el_vars) - 1, "")
-            model.add(penalty >= sum(el_vars) - 1)
+            model.add(penalty >= cp_model.LinearExpr.sum(el_vars) - 1)
             penalties.append(penalty)
-    return PENALTY_ENTROPY * sum(penalties)
+    return round(PENALTY_ENTROPY * SCALE) * cp_model.LinearExpr.sum(penalties)
 
 
+@phased
 def penalize_high_sigma(model, vars, consts):
+    """
+    Penalize the square of the number of acts of each actor, bounded below
+    by its tangents at the points of 'sigma_cuts'. The bound is exact on the
+    points, which cover every number up to twice the fair share of acts or
+    the largest @acts.
+    """
     penalties = []
-    num_nodes = len(consts["nodes"])
-    for actor in consts["actors"]:
-        penalty = model.new_int_var(0, num_nodes**2, "")
-        sum_acts = model.new_int_var(0, num_nodes, "")
-        acts = [vars[(actor, *node)] for node in consts["nodes"]]
-        model.add(sum_acts == sum(acts))
-        model.add_multiplication_equality(penalty, [sum_acts, sum_acts])
+    nodes, actors = len(consts["nodes"]), len(vars.actors)
+    ub = min(nodes, len(consts["rmap"]))  # at most one per root
+    acts = [d["@"] for d in consts["prefs"].values() if d["@"]]
+    ks = sigma_cuts(ub, max([2 * -(-nodes // max(actors, 1))] + acts))
+    for a in range(len(vars.actors)):
+        penalty = model.new_int_var(0, ub**2, "")
+        sum_acts = model.new_int_var(0, ub, "")
+        model.add(sum_acts == cp_model.LinearExpr.sum(vars.row(a)))
+        for k in ks:
+            model.add(penalty >= 2 * k * sum_acts - k * k)
         penalties.append(penalty)
-    return PENALTY_SIGMA * sum(penalties)
+    return round(PENALTY_SIGMA * SCALE) * cp_model.LinearExpr.sum(penalties)
 
 
+def sigma_cuts(ub, dense):
+    """
+    Points of tangents to squares of numbers in [0, ub]: every number up to
+    'dense', then 'SIGMA_CUTS' points spaced evenly up to 'ub'. Tangents
+    keep balanced counts cheaper than unbalanced ones wherever counts fall.
+
+    >>> ks = sigma_cuts(365, 24)
+    >>> def square(x):
+    ...     return max(2 * k * x - k * k for k in ks)
+    >>> square(12) + square(12), square(6) + square(18), square(5) + square(19)
+    (288, 360, 386)
+    """
+    dense = min(ub, dense)
+    return sorted(
+        {*range(dense + 1)}
+        | {
+            round(dense + (ub - dense) * i / (SIGMA_CUTS - 1))
+            for i in range(SIGMA_CUTS)
+        }
+    )
+
+
+@phased
 def collect_results(solver, vars, coeffs, consts):
     o = dict(nodes={}, actors=defaultdict(list))
-    for actor in consts["actors"]:
-        for node in consts["nodes"]:
-            act = (actor, *node)
-            if solver.value(vars[act]) == 1:
-                if coeffs[act]:
-                    o["nodes"][node] = actor
-                    o["actors"][actor].append(node)
-                else:
-                    o["nodes"][node] = "*"
+    for k, x in enumerate(vars.values(solver)):
+        if x:
+            actor, *node = vars.act(k)
+            node = tuple(node)
+            if coeffs[k]:
+                o["nodes"][node] = actor
+                o["actors"][actor].append(node)
+            else:
+                o["nodes"][node] = "*"
+    return o
+
+
+# ----------------------------
+# build, dump and load models
+# ----------------------------
+def build_model(consts, engine="python", names=False):
+    """
+    Build the model of 'consts', returning it with its variables, their
+    coefficients, the cap of acts per actor and the penalty. The objective
+    is left to 'set_objective', as its noise is drawn again on every run.
+    With 'names', variables of acts are named after their actor and node.
+    """
+    model = cp_model.CpModel()
+    vars = gen_vars(model, consts, names)
+    policy = process_policy_np if engine == "numpy" else process_policy
+    coeffs = policy(model, vars, consts)
+    cap = model.new_int_var(1, max(len(consts["nodes"]), 1), "max_acts")
+    rule_single_actor_per_node(model, vars, consts)
+    rule_at_most_one_act_per_root(model, vars, consts)
+    rule_clip_acts_per_actor(model, vars, consts, cap)
+    rule_rest_between_acts(model, vars, consts)
+    penalty = penalize_low_entropy(model, vars, consts)
+    penalty += penalize_high_sigma(model, vars, consts)
+    return model, vars, coeffs, cap, penalty
+
+
+def dump_model(model, vars, coeffs, cap, penalty):
+    """
+    Serialize a model built by 'build_model' into a picklable dict: the
+    proto in text format, and the proto indices of the variables of acts,
+    of the cap and of the terms of the penalty.
+
+    >>> consts = dict(actors=["sofia"], nodes=[("1", "a")], rmap={"1": [0]})
+    >>> consts.update(index={"1": 1, "a": 1}, rest={"sofia": 0})
+    >>> consts.update(prefs={"sofia": read_prefs([])})
+    >>> o = dump_model(*build_model(consts))
+    >>> o["vars"], o["cap"]
+    ([0], 1)
+    >>> model, vars, coeffs, cap, penalty = load_model(o)
+    >>> str(model.proto) == str(build_model(consts)[0].proto)
+    True
+    """
+    penalty = cp_model.FlatIntExpr(penalty)
+    return dict(
+        ortools=ortools.__version__,
+        proto=zlib.compress(str(model.proto).encode(), 1),
+        actors=vars.actors,
+        nodes=vars.nodes,
+        vars=[-1 if v is None else v.index for v in vars.vars],
+        coeffs=coeffs,
+        cap=cap.index,
+        penalty=([v.index for v in penalty.vars], list(penalty.coeffs), penalty.offset),
+    )
+
+
+def load_model(o):
+    """Rebuild a model and its variables from 'dump_model'"""
+    model = cp_model.CpModel()
+    model.proto.parse_text_format(zlib.decompress(o["proto"]).decode())
+    var = model.get_int_var_from_proto_index
+    vars = table(
+        o["actors"],
+        o["nodes"],
+        [None if i < 0 else model.get_bool_var_from_proto_index(i) for i in o["vars"]],
+    )
+    ids, coeffs, offset = o["penalty"]
+    penalty = cp_model.LinearExpr.weighted_sum(mapl(var, ids), coeffs) + offset
+    return model, vars, o["coeffs"], var(o["cap"]), penalty
+
+
+# ------------------------------------
+# solve in blocks of roots in parallel
+# ------------------------------------
+def solve_by_blocks(args, consts, start):
+    """
+    Split roots into blocks of 'args.block' roots and solve them in a pool
+    of processes: even blocks first, then odd blocks with the rest windows
+    crossing their boundaries closed by the acts of their neighbours.
+    Counts per actor (@acts and relations) are shared out among blocks in
+    proportion to the nodes each actor may take. Each block caps an actor
+    at the acts they require there plus a share of the rest of the cap:
+    the even blocks share it first, leaving what they did not take to the
+    odd.
+
+    >>> from argparse import Namespace
+    >>> consts = load_lot("examples/demo.lot", cache=False)
+    >>> actors = consts["policy"].keys()
+    >>> consts.update(actors=actors, rest=dict.fromkeys(actors, 0))
+    >>> consts.update(search=dict(workers=1, seed=1))
+    >>> random.seed(1)
+    >>> args = Namespace(block=7, jobs=1, max_it=None, engine="python")
+    >>> o = solve_by_blocks(args, consts, time.monotonic())
+    >>> max(map(len, o["actors"].values()))  # the cap of the single model
+    15
+    """
+    nodes, rmap, index = consts["nodes"], consts["rmap"], consts["index"]
+    actors = list(consts["actors"])
+    rest = {
+        actor: consts["rest"][actor] if isinstance(d["/"], list) else d["/"]
+        for actor, d in consts["prefs"].items()
+    }
+    roots = list(rmap)
+    size = max(args.block, *rest.values())  # neighbours of a block never meet
+    blocks = [roots[i : i + size] for i in range(0, len(roots), size)]
+    ids = [[i for r in b for i in rmap[r]] for b in blocks]
+    masks = [sum(1 << i for i in x) for x in ids]
+    params = dict(consts["search"])
+    jobs = args.jobs or os.cpu_count()
+    params["workers"] = max(1, (params.get("workers") or os.cpu_count()) // jobs)
+
+    def share(n, m):  # share 'n' of counts over nodes of 'm' among blocks
+        return apportion(n, [bin(m & x).count("1") for x in masks])
+
+    # counts per actor shared out among blocks
+    acts, rels = {}, {}
+    allowed = dict(zip(actors, gen_allowed(consts)))
+    for actor, d in consts["prefs"].items():
+        if d["@"]:
+            acts[actor] = share(d["@"], allowed[actor])
+        rels[actor] = []
+        for key, sym, val in d["q"]:
+            m = match_index(index, [key])
+            if sym in ("<", "<="):
+                rels[actor].append((key, "<=", share(int(val) - (sym == "<"), m)))
+            elif sym in (">", ">="):
+                rels[actor].append((key, ">=", share(int(val) + (sym == ">"), m)))
+            else:
+                rels[actor].append((key, sym, share(int(val), m)))
+
+    # least acts each actor must take in each block
+    need = [
+        [
+            max(
+                [acts[actor][k] if actor in acts else 0]
+                + [val[k] for _, sym, val in rels[actor] if sym in ("=", ">=")]
+            )
+            for k in range(len(blocks))
+        ]
+        for actor in actors
+    ]
+
+    def caps(wave):  # caps of each actor in blocks of 'wave' out of acts left
+        ks = range(wave, len(blocks), 2)
+        w = [len(ids[k]) for k in ks]
+        o = []
+        for a, n in enumerate(left):
+            if wave:
+                free = n - sum(need[a][k] for k in ks)
+            else:
+                free = Fraction((max_acts - sum(need[a])) * sum(w), len(nodes))
+            extra = spread(max(free, 0), w, Fraction(a, len(actors)))
+            o.append([need[a][k] + x for k, x in zip(ks, extra)])
+        return o
+
+    def task(k, cap, forbid, seed, budget):
+        sub = [nodes[i] for i in ids[k]]
+        prefs, forbid = {}, dict(forbid)
+        for a, (actor, d) in enumerate(consts["prefs"].items()):
+            d = defaultdict(list, d)
+            if actor in acts:
+                d["@"] = acts[actor][k]
+                if not d["@"]:  # no acts in this block
+                    forbid[a] = range(len(sub))
+            d["q"] = [(key, sym, str(val[k])) for key, sym, val in rels[actor]]
+            prefs[actor] = d
+        return dict(
+            actors=actors,
+            nodes=sub,
+            rmap=gen_rmap(sub),
+            index=gen_index(sub),
+            prefs=prefs,
+            rest=dict(rest),
+            cap=cap,
+            forbid=forbid,
+            at_least_once=False,
+            engine=args.engine,
+            search=params,
+            budget=budget,
+            seed=seed,
+        )
+
+    pos = {r: i for i, r in enumerate(roots)}
+
+    def boundary(k, done):  # nodes of block 'k' within rest windows of neighbours
+        o = defaultdict(set)
+        local = {i: j for j, i in enumerate(ids[k])}
+        for j in (k - 1, k + 1):
+            if not 0 <= j < len(blocks) or done[j] is None:
+                continue
+            for x, _ in done[j]:
+                a, i = divmod(x, len(ids[j]))
+                r, m = pos[fst(nodes[ids[j][i]])], rest[actors[a]]
+                for r_ in roots[max(0, r - m) : r + m + 1]:
+                    o[a].update(local[i_] for i_ in rmap[r_] if i_ in local)
+        return o
+
+    max_acts = len(nodes) // len(actors) or 1
+    max_it = args.max_it or 5
+    it = 0
+    while True:
+        done = [None] * len(blocks)
+        left = [max_acts] * len(actors)
+        # no block can keep an actor needing more acts than the cap under it
+        for wave in (0, 1) if all(sum(x) <= max_acts for x in need) else ():
+            ks = range(wave, len(blocks), 2)
+            cap = caps(wave)
+            # the waves share the time left, and the rounds of the pool a wave
+            budget = time_left(params, start)
+            if budget is not None:
+                budget /= (2 - wave) * -(-len(ks) // jobs)
+            # noise of each block is seeded here: children of every pool
+            # inherit the same state of the parent's generator
+            tasks = [
+                task(
+                    k,
+                    [c[j] for c in cap],
+                    boundary(k, done) if wave else {},
+                    random.getrandbits(32),
+                    budget,
+                )
+                for j, k in enumerate(ks)
+            ]
+            for k, x in zip(ks, parmap(solve_block, tasks, workers=jobs)):
+                done[k] = x and x[0]
+                if x and not x[1]:  # stopped by a time limit
+                    consts["interrupted"] = True
+            if any(done[k] is None for k in ks):
+                break
+            for k in ks:
+                for act, _ in done[k]:
+                    left[act // len(ids[k])] -= 1
+        stitched = all(x is not None for x in done)
+        if stitched:
+            o = dict(nodes={}, actors=defaultdict(list))
+            for k, x in enumerate(done):
+                for act, c in x:
+                    a, i = divmod(act, len(ids[k]))
+                    node = nodes[ids[k][i]]
+                    if c:
+                        o["nodes"][node] = actors[a]
+                        o["actors"][actors[a]].append(node)
+                    else:
+                        o["nodes"][node] = "*"
+            if valid_results(consts, o):
+                return o
+        if it > max_it:
+            error(f"Aborted. Exceeded maximum iterations: {max_it}", e=Exception)
+        if not stitched:  # an invalid stitch tries the same cap with new noise
+            max_acts += 1
+        it += 1
+
+
+def solve_block(consts):
+    """
+    Solve a block of roots, and return its acts taken with coefficients
+    and whether they are optimal
+    """
+    model = cp_model.CpModel()
+    vars = gen_vars(model, consts)
+    policy = process_policy_np if consts["engine"] == "numpy" else process_policy
+    coeffs = policy(model, vars, consts)
+    rule_single_actor_per_node(model, vars, consts)
+    rule_at_most_one_act_per_root(model, vars, consts)
+    rule_clip_acts_per_actor(model, vars, consts, consts["cap"])
+    rule_rest_between_acts(model, vars, consts)
+    random.seed(consts["seed"])
+    set_objective(model, vars, coeffs, consts)
+    solver = gen_solver(consts["search"], consts["budget"])
+    status = solver.solve(model)
+    if status not in (cp_model.FEASIBLE, cp_model.OPTIMAL):
+        return None
+    acts = [(k, coeffs[k]) for k, x in enumerate(vars.values(solver)) if x]
+    return acts, status == cp_model.OPTIMAL
+
+
+def spread(n, weights, phase=0):
+    """
+    Share 'n' out in proportion to 'weights' by rounding down their running
+    total shifted by 'phase', so shares of many with phases spread over
+    [0, 1) add up in proportion to 'weights' as well.
+
+    >>> spread(3, [1, 1, 1, 1]), spread(3, [1, 1, 1, 1], 0.5)
+    ([0, 1, 1, 1], [1, 1, 0, 1])
+    """
+    total, run, o = sum(weights), 0, []
+    prev = math.floor(phase)
+    for w in weights:
+        run += w
+        x = math.floor(phase + Fraction(n) * run / total)
+        o.append(x - prev)
+        prev = x
+    return o
+
+
+def apportion(n, weights):
+    """
+    Share 'n' out in proportion to 'weights' by the largest remainders.
+
+    >>> apportion(10, [7, 7, 7, 3])
+    [3, 3, 3, 1]
+    >>> apportion(2, [0, 0])
+    [2, 0]
+    """
+    total = sum(weights)
+    if not total or n < 0:
+        return [n] + [0] * (len(weights) - 1)
+    q = [n * w / total for w in weights]
+    o = [int(x) for x in q]
+    for i in sorted(range(len(q)), key=lambda i: o[i] - q[i])[: n - sum(o)]:
+        o[i] += 1
     return o
 
 
 # ----------------------
 # report and dump files
 # ----------------------
-def report_and_export(consts, o, args):
+@phased
+def report_and_export(consts, o, args, show=True):
     def jx(node):
         return ":".join(node)
 
@@ -599,6 +1907,12 @@ def report_and_export(consts, o, args):
             ws.append([jx(node), o["nodes"][node]])
         adjust(ws)
 
+    def search_xl(wb):
+        ws = wb.create_sheet(title="Search")
+        for k, v in (consts.get("search") or {}).items():
+            ws.append([k, "" if v is None else str(v)])
+        adjust(ws)
+
     def to_cal_xl(wb):
         cal, days, events, year, month = base_cal()
         ws = wb.create_sheet(title=f"{year}-{month:02d}")
@@ -629,18 +1943,34 @@ def report_and_export(consts, o, args):
                 ws.append(e)
         adjust(ws)
 
-    if args.actor:
+    if show and args.actor:
         by_actors()
-    if args.node:
+    if show and args.node:
         by_nodes()
-    if args.cal:
+    if show and args.cal:
         to_cal()
+    if args.dump:
+        with writer(args.dump, "w", encoding="utf-8") as f:
+            json.dump(
+                dict(
+                    nodes={jx(node): o["nodes"][node] for node in consts["nodes"]},
+                    actors={
+                        actor: [jx(node) for node in o["actors"][actor]]
+                        for actor in consts["actors"]
+                    },
+                    search=consts.get("search"),
+                ),
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
     if args.output:
         wb = openpyxl.Workbook()
         wb.remove(wb.active)
         to_cal_xl(wb)
         by_nodes_xl(wb)
         by_actors_xl(wb)
+        search_xl(wb)
         wb.save(
             args.output
             if args.output.split(".")[-1] in ("xlsx", "xls")
@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from unicodedata import east_asian_width
 
 from foc import *
@@ -8,35 +9,89 @@ def cast(f):
     def go(s, *args, **kwargs):
         return f(state(s) if isinstance(s, str) else s, *args, **kwargs)
 
+    go.memo = True  # made once per definition, so its results can be reused
     return go
 
 
+def parser(q):
+    """Wrap a parser 'q' that returns a 'failure' instead of raising.
+
+    Nested within another parser, the failure is handed back as is.
+    Only the outermost parser raises it as a 'ParseError'.
+    """
+
+    def parse(s):
+        x = q(state(s) if isinstance(s, str) else s)
+        if DEPTH or type(x) is not failure:
+            return x
+        raise x.error()
+
+    parse.quiet = q
+    return parse
+
+
+def attempt(p, s):
+    """Apply 'p' to 's' and return either its result or a 'failure'"""
+    # parsers built per call (closures) never hit again: apply them directly
+    if PACKRAT is None or (
+        getattr(p, "__closure__", None) is not None and not hasattr(p, "memo")
+    ):
+        return quietly(p, s)
+    return PACKRAT(p, s)
+
+
+def quietly(p, s):
+    q = getattr(p, "quiet", None)
+    if q is not None:
+        return q(s)
+    global DEPTH
+    DEPTH += 1
+    try:
+        return p(s)
+    except ParseError as e:
+        return failure(e.reason, e.s, e.expected)
+    finally:
+        DEPTH -= 1
+
+
+def chain(s, *ps):
+    """Apply parsers in sequence: a list of results or the first failure"""
+    o = []
+    for p in ps:
+        x = attempt(p, s)
+        if type(x) is failure:
+            return x
+        r, s = x
+        o.append(r)
+    return o, s
+
+
 def many(p, fold=False):
-    @cast
     def parse(s):
         o = []
         while s:
-            try:
-                r, s = p(s)
-                o.append(r)
-            except ParseError as e:
-                if e.s > s:
-                    raise e
+            x = attempt(p, s)
+            if type(x) is failure:
+                if x.s > s:
+                    return x
                 break
+            r, s = x
+            o.append(r)
         return unchars(o) if fold else o, s
 
-    return parse
+    return parser(parse)
 
 
 def some(p, fold=False):
-    @cast
     def parse(s):
-        r, s = p(s)
-        m, s = many(p)(s)
+        x = chain(s, p, many(p))
+        if type(x) is failure:
+            return x
+        (r, m), s = x
         o = cons(r, m)
         return unchars(o) if fold else o, s
 
-    return parse
+    return parser(parse)
 
 
 def choice(*ps):
@@ -45,19 +100,17 @@ def choice(*ps):
     ('7', '77')
     """
 
-    @cast
     def parse(s):
         error = None
         for p in ps:
-            try:
-                return p(s)
-            except ParseError as e:
-                if not error or e.s > error.s:
-                    error = e
-                pass
-        raise error
+            x = attempt(p, s)
+            if type(x) is not failure:
+                return x
+            if not error or x.s > error.s:
+                error = x
+        return error
 
-    return parse
+    return parser(parse)
 
 
 def option(default, p):
@@ -66,14 +119,11 @@ def option(default, p):
     ('7', 'seven')
     """
 
-    @cast
     def parse(s):
-        try:
-            return p(s)
-        except ParseError as e:
-            return default, e.s
+        x = attempt(p, s)
+        return (default, x.s) if type(x) is failure else x
 
-    return parse
+    return parser(parse)
 
 
 def count(n, p):
@@ -82,15 +132,10 @@ def count(n, p):
     (['f', 'f', 'f'], 'fff')
     """
 
-    @cast
     def parse(s):
-        o = []
-        for _ in range(n):
-            r, s = p(s)
-            o.append(r)
-        return o, s
+        return chain(s, *[p] * n)
 
-    return parse
+    return parser(parse)
 
 
 def atleast(n, p):
@@ -99,14 +144,15 @@ def atleast(n, p):
     (['f', 'f', 'f', 'f', 'f', 'f'], '')
     """
 
-    @cast
     def parse(s):
-        o, s = count(n, p)(s)
-        q, s = many(p)(s)
+        x = chain(s, count(n, p), many(p))
+        if type(x) is failure:
+            return x
+        (o, q), s = x
         o.extend(q)
         return o, s
 
-    return parse
+    return parser(parse)
 
 
 def atmost(n, p):
@@ -118,14 +164,14 @@ def atmost(n, p):
     def parse(s):
         o = []
         for _ in range(n):
-            try:
-                r, s = p(s)
-                o.append(r)
-            except ParseError:
+            x = attempt(p, s)
+            if type(x) is failure:
                 break
+            r, s = x
+            o.append(r)
         return o, s
 
-    return parse
+    return parser(parse)
 
 
 def between(bra, ket, p):
@@ -134,14 +180,14 @@ def between(bra, ket, p):
     ('777', '')
     """
 
-    @cast
     def parse(s):
-        _, s = bra(s)
-        r, s = p(s)
-        _, s = ket(s)
+        x = chain(s, bra, p, ket)
+        if type(x) is failure:
+            return x
+        (_, r, _), s = x
         return r, s
 
-    return parse
+    return parser(parse)
 
 
 def sepby(sep, p):
@@ -151,21 +197,20 @@ def sepby(sep, p):
     """
 
     def go(s):
-        _, s = sep(s)
-        r, s = p(s)
+        x = chain(s, sep, p)
+        if type(x) is failure:
+            return x
+        (_, r), s = x
         return r, s
 
-    @cast
     def parse(s):
-        o = []
-        r, s = p(s)
-        o.append(r)
-        r, s = many(go)(s)
-        if r:
-            o.extend(r)
-        return o, s
+        x = chain(s, p, many(parser(go)))
+        if type(x) is failure:
+            return x
+        (r, o), s = x
+        return cons(r, o), s
 
-    return parse
+    return parser(parse)
 
 
 def endby(end, p):
@@ -175,15 +220,13 @@ def endby(end, p):
     """
 
     def go(s):
-        r, s = p(s)
-        _, s = end(s)
+        x = chain(s, p, end)
+        if type(x) is failure:
+            return x
+        (r, _), s = x
         return r, s
 
-    @cast
-    def parse(s):
-        return some(go)(s)
-
-    return parse
+    return some(parser(go))
 
 
 def manytill(end, p, fold=False):
@@ -194,15 +237,16 @@ def manytill(end, p, fold=False):
     ('bleu', 'rosso')
     """
 
-    @cast
     def parse(s):
-        try:
-            return sometill(end, p, fold=fold)(s)
-        except ParseError:
-            _, s = end(s)
-            return [], s
+        x = attempt(sometill(end, p, fold=fold), s)
+        if type(x) is not failure:
+            return x
+        x = attempt(end, s)
+        if type(x) is failure:
+            return x
+        return [], snd(x)
 
-    return parse
+    return parser(parse)
 
 
 def sometill(end, p, fold=False):
@@ -211,19 +255,21 @@ def sometill(end, p, fold=False):
     (['3'], '141592')
     """
 
-    @cast
     def parse(s):
         o = []
         while True:
-            try:
-                r, s = end(s)
+            x = attempt(end, s)
+            if type(x) is not failure:
+                s = snd(x)
                 break
-            except ParseError:
-                r, s = p(s)
-                o.append(r)
+            x = attempt(p, s)
+            if type(x) is failure:
+                return x
+            r, s = x
+            o.append(r)
         return unchars(o) if fold else o, s
 
-    return parse
+    return parser(parse)
 
 
 def skip(p):
@@ -232,12 +278,11 @@ def skip(p):
     (None, 'ofia')
     """
 
-    @cast
     def parse(s):
-        _, s = p(s)
-        return None, s
+        x = attempt(p, s)
+        return x if type(x) is failure else (None, snd(x))
 
-    return parse
+    return parser(parse)
 
 
 def skipmany(p):
@@ -257,39 +302,32 @@ def skipsome(p):
 
 
 def peek(p):
-    @cast
     def parse(s):
-        try:
-            _, _ = p(s)
-            return True, s
-        except ParseError as e:
-            raise e
+        x = attempt(p, s)
+        return x if type(x) is failure else (True, s)
 
-    return parse
+    return parser(parse)
 
 
 @fx
 def label(expected, p):
-    @cast
     def parse(s):
-        try:
-            return p(s)
-        except ParseError as e:
-            fail("", e.s, expected=expected)
+        x = attempt(p, s)
+        return failure("", x.s, expected, x.got) if type(x) is failure else x
 
-    return parse
+    return parser(parse)
 
 
 def charby(predicate):
-    @cast
     def parse(s):
         if not s:
-            fail("Reached end-of-stream", s.get("EOF"))
-        if predicate(s[0]):
-            return s[0], s.update(s[0])
-        fail("Unexpected char", s.get(s[0]))
+            return failure("Reached end-of-stream", s, got="EOF")
+        c = s[0]
+        if predicate(c):
+            return c, s.update(c)
+        return failure("Unexpected char", s, got=c)
 
-    return parse
+    return parser(parse)
 
 
 def char(c):
@@ -368,7 +406,7 @@ def floating(s):
     """
     q, s = option("", char("-"))(s)
     if q:
-        peek(digit)(s)
+        _, _ = peek(digit)(s)
     i, s = option("", digits)(s)
     p, s = char(".")(s)
     d, s = digits(s)
@@ -389,15 +427,14 @@ def string(cs):
     ('ave-', 'maria')
     """
 
-    @cast
     def parse(s):
-        o = []
-        for c in cs:
-            r, s = char(c)(s)
-            o.append(r)
+        x = chain(s, *map(char, cs))
+        if type(x) is failure:
+            return x
+        o, s = x
         return unchars(o), s
 
-    return parse
+    return parser(parse)
 
 
 @cast
@@ -415,15 +452,14 @@ def anystringbut(cs):
     ('-273', '.15')
     """
 
-    @cast
     def parse(s):
         o = []
-        while s and not s.rest.startswith(cs):
+        while s and not s.src.startswith(cs, s.pos):
             c, s = anychar(s)
             o.append(c)
         return unchars(o), s
 
-    return label(f"any string but '{cs}'", parse)
+    return label(f"any string but '{cs}'", parser(parse))
 
 
 @cast
@@ -512,13 +548,14 @@ def lexeme(consumer):
     """
 
     def consume(p):
-        @cast
         def parse(s):
-            r, s = p(s)
-            _, s = consumer(s)
+            x = chain(s, p, consumer)
+            if type(x) is failure:
+                return x
+            (r, _), s = x
             return r, s
 
-        return parse
+        return parser(parse)
 
     return consume
 
@@ -590,48 +627,79 @@ def angles(p):
 
 
 class state:
-    __slots__ = ("rest", "line", "col", "buf", "got")
+    __slots__ = ("src", "pos", "line", "col", "bol", "got")
 
-    def __init__(self, rest, line=1, col=1, buf=None, got=None):
-        self.rest = rest
+    def __init__(self, src, pos=0, line=1, col=1, bol=0, got=None):
+        self.src = src  # source buffer shared by all states of a parse
+        self.pos = pos  # offset of the next char to consume
         self.line = line
         self.col = col
-        self.buf = self.from_rest(3) if buf is None else buf
+        self.bol = bol  # offset of the beginning of the current line
         self.got = got
 
     def update(self, c):
         if c == "\n":
-            return state(self.rest[1:], self.line + 1, 1, None)
+            return state(self.src, self.pos + 1, self.line + 1, 1, self.pos + 1)
         elif c == "\t":
-            return state(self.rest[1:], self.line, self.col + 4, self.buf)
+            return state(self.src, self.pos + 1, self.line, self.col + 4, self.bol)
         else:
-            return state(self.rest[1:], self.line, self.col + 1, self.buf)
+            return state(self.src, self.pos + 1, self.line, self.col + 1, self.bol)
+
+    def seek(self, pos):
+        def width(i, j):
+            return j - i + 3 * self.src.count("\t", i, j)
+
+        n = self.src.count("\n", self.pos, pos)
+        if n:
+            bol = self.src.rfind("\n", self.pos, pos) + 1
+            return state(self.src, pos, self.line + n, 1 + width(bol, pos), bol)
+        return state(
+            self.src, pos, self.line, self.col + width(self.pos, pos), self.bol
+        )
+
+    @property
+    def rest(self):
+        return self.src[self.pos :]
 
-    def from_rest(self, n=1):
-        return self.rest.split("\n")[:n]
+    @property
+    def buf(self):
+        return self.from_bol(3)
+
+    def from_bol(self, n=1):
+        o, i = [], self.bol
+        for _ in range(n):
+            j = self.src.find("\n", i)
+            if j < 0:
+                o.append(self.src[i:])
+                break
+            o.append(self.src[i:j])
+            i = j + 1
+        return o
 
     def get(self, got):
-        return state(self.rest, self.line, self.col, self.buf, got=got)
+        return state(self.src, self.pos, self.line, self.col, self.bol, got=got)
 
     def __repr__(self):
         return repr(self.rest)
 
     def __bool__(self):
-        return bool(self.rest)
+        return self.pos < len(self.src)
 
     def __eq__(self, o):
-        return self.line == o.line and self.col == o.col
+        return self.pos == o.pos
 
     def __gt__(self, o):
-        return self.line > o.line or (self.line == o.line and self.col > o.col)
+        return self.pos > o.pos
 
     def __lt__(self, o):
         return o.__gt__(self)
 
     def __len__(self):
-        return len(self.rest)
+        return len(self.src) - self.pos
 
     def __getitem__(self, index):
+        if isinstance(index, int) and index >= 0:
+            return self.src[self.pos + index]
         return self.rest[index]
 
 
@@ -640,7 +708,10 @@ class ParseError(Exception):
         self.reason = reason
         self.s = s
         self.expected = expected
-        super().__init__(self.format_error())
+        super().__init__()
+
+    def __str__(self):
+        return self.format_error()
 
     def format_error(self):
         def escape(s):
@@ -677,6 +748,29 @@ class ParseError(Exception):
         return unlines(errors)
 
 
+class failure:
+    """Parse failure handed back by parsers instead of raising.
+
+    Unpacking it as a '(result, state)' pair raises its 'ParseError',
+    so parsers written as plain functions still fail as before.
+    """
+
+    __slots__ = ("reason", "s", "expected", "got")
+
+    def __init__(self, reason, s, expected=None, got=None):
+        self.reason = reason
+        self.s = s
+        self.expected = expected
+        self.got = got  # set when 's' is yet to be marked with it
+
+    def error(self):
+        s = self.s if self.got is None else self.s.get(self.got)
+        return ParseError(self.reason, s, expected=self.expected)
+
+    def __iter__(self):
+        raise self.error()
+
+
 def fail(reason, s, expected=None):
     raise ParseError(reason, s, expected=expected)
 
@@ -689,3 +783,59 @@ def run_parser(p, s):
         raise e
     except Exception as e:
         raise e
+
+
+class memo:
+    """Packrat table of parser results keyed by (parser, position).
+
+    Positions behind the current one are evicted once the table is full,
+    so it stays bounded by 'size' positions while parsing moves forward.
+    """
+
+    __slots__ = ("src", "table", "size")
+
+    def __init__(self, size=4096):
+        self.src = None
+        self.table = {}
+        self.size = size
+
+    def __call__(self, p, s):
+        if s.src is not self.src:
+            self.src = s.src
+            self.table.clear()
+        o = self.table.get(s.pos, {}).get(p)
+        if o is None:
+            o = quietly(p, s)
+            if s.pos not in self.table and len(self.table) >= self.size:
+                self.evict(s.pos)
+            self.table.setdefault(s.pos, {})[p] = o
+        return o
+
+    def evict(self, pos):
+        behind = [k for k in self.table if k < pos]
+        if len(behind) < len(self.table) // 2:
+            self.table.clear()
+        else:
+            for k in behind:
+                del self.table[k]
+
+
+PACKRAT = None
+DEPTH = 0  # parsers applied within another parser
+
+
+@contextmanager
+def packrat(size=4096):
+    """Memoize parsers applied by 'choice', 'many', 'sepby', 'between'
+    and 'lexeme' within the block.
+
+    >>> with packrat():
+    ...     choice(sepby(char(","), digits), digits)("1,2,3")
+    (['1', '2', '3'], '')
+    """
+    global PACKRAT
+    prev, PACKRAT = PACKRAT, memo(size)
+    try:
+        yield PACKRAT
+    finally:
+        PACKRAT = prev
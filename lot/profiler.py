@@ -0,0 +1,188 @@
+import cProfile
+import functools
+import json
+import re
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+from ortools.sat.python import cp_model
+from ouch import writer
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+PROFILE = None  # profile of the current run, if any
+
+
+class profile:
+    """Wall time, CPU time and peak memory of the phases of a run, along
+    with the statistics of its model and of each solve.
+
+    >>> p = profile()
+    >>> with p.phase("gen_vars"):
+    ...     _ = [0] * 1000
+    >>> p.phases["gen_vars"]["calls"]
+    1
+    """
+
+    __slots__ = ("phases", "model", "solves", "log", "start")
+
+    def __init__(self):
+        self.phases = {}
+        self.model = None
+        self.solves = []
+        self.log = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        wall, cpu, rss = time.perf_counter(), time.process_time(), peak_rss()
+        try:
+            yield
+        finally:
+            o = self.phases.setdefault(
+                name, dict(calls=0, wall=0.0, cpu=0.0, peak_rss=None, rss_growth=0)
+            )
+            o["calls"] += 1
+            o["wall"] += time.perf_counter() - wall
+            o["cpu"] += time.process_time() - cpu
+            if rss is not None:
+                o["peak_rss"] = peak_rss()
+                o["rss_growth"] += o["peak_rss"] - rss
+
+    def json(self):
+        return dict(
+            wall=time.perf_counter() - self.start,
+            cpu=time.process_time(),
+            peak_rss=peak_rss(),
+            phases=self.phases,
+            model=self.model,
+            solves=self.solves,
+        )
+
+
+def peak_rss():
+    """Peak resident set size of the process so far in bytes"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+@contextmanager
+def profiling(f=None, pstats=None):
+    """
+    Profile phases while running the block, then write them as JSON to 'f',
+    and the statistics of cProfile to 'pstats' if given.
+    """
+    global PROFILE
+    if not f and not pstats:
+        yield
+        return
+    PROFILE = profile()
+    prof = cProfile.Profile() if pstats else None
+    if prof:
+        prof.enable()
+    try:
+        yield
+    finally:
+        if prof:
+            prof.disable()
+            prof.dump_stats(pstats)
+        if f:
+            with writer(f, "w", encoding="utf-8") as fh:
+                json.dump(PROFILE.json(), fh, indent=2)
+        PROFILE = None
+
+
+def phase(name):
+    return PROFILE.phase(name) if PROFILE else nullcontext()
+
+
+def phased(f):
+    """Time every call of 'f' as the phase of its name while profiling"""
+
+    @functools.wraps(f)
+    def go(*args, **kwargs):
+        if PROFILE is None:
+            return f(*args, **kwargs)
+        with PROFILE.phase(f.__name__):
+            return f(*args, **kwargs)
+
+    return go
+
+
+def timed(name, xs):
+    """Iterate 'xs', timing each step as the phase 'name' while profiling"""
+    it, end = iter(xs), object()
+    while True:
+        with phase(name):
+            x = next(it, end)
+        if x is end:
+            return
+        yield x
+
+
+def record_model(model):
+    """
+    Record the size of 'model': numbers of variables, of constraints by type
+    and of terms in the objective.
+    """
+    if PROFILE is None:
+        return
+
+    def num(x):
+        return int(x.replace("'", ""))
+
+    stats = model.model_stats()
+    PROFILE.model = dict(
+        variables=num(re.search(r"#Variables: ([\d']+)", stats).group(1)),
+        constraints={
+            k: num(v) for k, v in re.findall(r"^#k(\w+): ([\d']+)", stats, re.M)
+        },
+        objective_terms=len(model.proto.objective.vars),
+    )
+
+
+def watch(solver):
+    """Log the search of 'solver' to read its presolve time while profiling"""
+    if PROFILE is None:
+        return
+    PROFILE.log = {}
+    p = solver.parameters
+    if not p.log_search_progress:
+        p.log_search_progress = True
+        p.log_to_stdout = False
+
+    def log(line):
+        m = re.match(r"Starting search at ([\d.]+)s", line)
+        if m:
+            PROFILE.log["presolve"] = float(m.group(1))
+
+    solver.log_callback = log
+
+
+def record_solve(solver, status, **kwargs):
+    """Record the response of a solve of 'solver' with 'kwargs' of its context"""
+    if PROFILE is None:
+        return
+    found = status in (cp_model.FEASIBLE, cp_model.OPTIMAL)
+    obj = solver.objective_value if found else None
+    bound = solver.best_objective_bound if found else None
+    PROFILE.solves.append(
+        dict(
+            **kwargs,
+            status=solver.status_name(status),
+            wall=solver.wall_time,
+            user=solver.user_time,
+            presolve=PROFILE.log.get("presolve"),
+            branches=solver.num_branches,
+            conflicts=solver.num_conflicts,
+            objective=obj,
+            bound=bound,
+            gap=abs(bound - obj) / max(abs(obj), 1e-9) if found else None,
+        )
+    )
@@ -12,7 +12,7 @@ class _help_formatter(argparse.HelpFormatter):
         super().__init__(prog, max_help_position=30)
 
     def _format_usage(self, *args):
-        return "Usage: lot [options] FILE\n"
+        return "Usage: lot [options] FILE...\n"
 
 
 def main():
@@ -22,7 +22,7 @@ def main():
         formatter_class=_help_formatter,
         add_help=False,
     )
-    parser.add_argument("FILE", nargs="?", help="Input FILE to process")
+    parser.add_argument("FILE", nargs="*", help="Input FILEs or globs to process")
     parser.add_argument(
         "-h",
         "--help",
@@ -69,6 +69,27 @@ def main():
         metavar="FILE",
         help="Save as spreadsheet FILE",
     )
+    parser.add_argument(
+        "-d",
+        "--dump",
+        type=str,
+        metavar="FILE",
+        help="Save results as JSON FILE",
+    )
+    parser.add_argument(
+        "-H",
+        "--hint",
+        type=str,
+        metavar="FILE",
+        help="Start from a previous result FILE",
+    )
+    parser.add_argument(
+        "-x",
+        "--export",
+        type=str,
+        metavar="FILE",
+        help="Save the model as FILE",
+    )
     parser.add_argument(
         "-A",
         "--max-it",
@@ -83,6 +104,116 @@ def main():
         metavar="INT",
         help="Set minimum number of rest",
     )
+    parser.add_argument(
+        "-M",
+        "--min-cap",
+        action="store_true",
+        help="Minimize the number of acts per actor first",
+    )
+    parser.add_argument(
+        "-I",
+        "--anytime",
+        action="store_true",
+        help="Report each better schedule while solving",
+    )
+    parser.add_argument(
+        "-s",
+        "--search",
+        choices=("fast", "balanced", "thorough"),
+        metavar="STR",
+        help="Set search profile: fast, balanced or thorough",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        metavar="INT",
+        help="Set number of search workers",
+    )
+    parser.add_argument(
+        "-t",
+        "--time-limit",
+        type=float,
+        metavar="SEC",
+        help="Set time limit per solve",
+    )
+    parser.add_argument(
+        "-T",
+        "--deadline",
+        type=float,
+        metavar="SEC",
+        help="Set time limit per run",
+    )
+    parser.add_argument(
+        "--presolve",
+        type=int,
+        metavar="INT",
+        help="Set presolve iterations, 0 to disable",
+    )
+    parser.add_argument(
+        "--linearization",
+        type=int,
+        metavar="INT",
+        help="Set linearization level: 0, 1 or 2",
+    )
+    parser.add_argument(
+        "--log",
+        action="store_true",
+        default=None,
+        help="Log search progress",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        metavar="INT",
+        help="Set random seed",
+    )
+    parser.add_argument(
+        "-C",
+        "--conf",
+        type=str,
+        metavar="FILE",
+        help="Read search parameters from FILE",
+    )
+    parser.add_argument(
+        "-b",
+        "--block",
+        type=int,
+        metavar="INT",
+        help="Solve in blocks of INT roots in parallel",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        metavar="INT",
+        help="Set number of processes for blocks or files",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=("python", "numpy"),
+        default="python",
+        metavar="STR",
+        help="Set engine for policy: python or numpy",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        metavar="FILE",
+        help="Save timings and statistics as JSON FILE",
+    )
+    parser.add_argument(
+        "--pstats",
+        type=str,
+        metavar="FILE",
+        help="Save cProfile statistics as FILE",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Run without the on-disk caches",
+    )
     parser.add_argument(
         "-V",
         "--version",
@@ -93,9 +224,12 @@ def main():
     args = parser.parse_args()
     if args.version:
         error(f"lot version is {__version__}")
-    if args.FILE is None:
+    if not args.FILE:
         parser.print_help()
+    elif len(args.FILE) > 1 or any(c in args.FILE[0] for c in "*?["):
+        solve_batch(args)
     else:
+        args.FILE = args.FILE[0]
         try:
             solve(args)
         except ParseError as e:
@@ -22,5 +22,6 @@ setuptools.setup(
     keywords="parser CSP DSL SAT",
     packages=setuptools.find_packages(),
     install_requires=["ortools", "openpyxl", "foc", "ouch"],
+    extras_require={"numpy": ["numpy"]},
     python_requires=">=3.6",
 )